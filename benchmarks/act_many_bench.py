@@ -0,0 +1,68 @@
+""" one actor acting on many targets: hnh.act_many against repeated hnh.act
+
+    for each number of targets, heals that many fresh players once with a
+    call to act per target and once with a single act_many, and reports
+    the time taken and the datastore transactions and RPCs made.
+
+    usage: python benchmarks/act_many_bench.py [max targets]
+"""
+import logging
+import sys
+import time
+from collections import defaultdict
+
+import sdk
+testbed = sdk.activate()
+
+from google.appengine.api import apiproxy_stub_map
+
+from models import Player, AttributeType
+import hnh
+
+TARGETS = [1, 5, 10, 25, 50]
+
+counts = defaultdict(int)
+
+
+def count_rpc(service, call, request, response):
+    counts['%s.%s' % (service, call)] += 1
+
+
+def measure(f):
+    counts.clear()
+    start = time.time()
+    f()
+    elapsed = (time.time() - start) * 1e3
+    datastore = sum(n for name, n in counts.items() if name.startswith('datastore_v3.'))
+    return elapsed, counts['datastore_v3.BeginTransaction'], datastore
+
+
+def main(max_targets=50):
+    logging.getLogger().setLevel(logging.ERROR)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('count_rpc', count_rpc)
+    AttributeType.create('health', recovery='0.1', decay='1.0', order=1.0)
+    # enough energy for the actor to heal everyone
+    AttributeType.create('energy', recovery='0.5', decay='1.0', order=2.0,
+                         max_value=10000.0, default_value=10000.0)
+    print '%8s %24s %24s' % ('', 'act per target', 'act_many')
+    print '%8s %8s %6s %8s %8s %6s %8s' % ('targets', 'ms', 'txns', 'rpcs', 'ms', 'txns', 'rpcs')
+    serial = 0
+    for n in [n for n in TARGETS if n <= max_targets]:
+        results = []
+        for variant in ('act', 'act_many'):
+            serial += 1
+            actor = Player.get_or_create('facebook', 'actor%d' % serial, 'actor')
+            targets = [Player.get_or_create('facebook', '%d-%d' % (serial, i), 'target')
+                       for i in xrange(n)]
+            if variant == 'act':
+                results.extend(measure(lambda: [hnh.act(actor, target, 'heal', 'bench') for target in targets]))
+            else:
+                results.extend(measure(lambda: hnh.act_many(actor, targets, 'heal', 'bench')))
+        print '%8d %8.1f %6d %8d %8.1f %6d %8d' % tuple([n] + results)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
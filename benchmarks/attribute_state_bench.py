@@ -0,0 +1,130 @@
+""" memory and cpu cost of the attribute state built for every view
+
+    compares hnh.AttributeState, which keeps its own values in slots and
+    reads the rest from the shared AttributeType, with the dict of ten
+    string keys per attribute that the views used before, on a batch of
+    player snapshots: building and sorting the states, rendering the
+    attribute bars with the same django template as index.html, and
+    converting them for the json status API.
+
+    usage: python benchmarks/attribute_state_bench.py [players]
+"""
+import sys
+import time
+from datetime import datetime
+
+import sdk
+testbed = sdk.activate()
+
+from django.conf import settings
+settings.configure()
+from django.template import Template, Context
+
+from models import AttributeType
+from hnh import AttributeState, predict_times, rate_towards_default
+
+BAR = Template("""{% for item in attribute_state %}<div data-value='{{item.value}}' data-rate='{{item.rate}}' data-max-value='{{item.max_value}}' data-default-value='{{item.default_value}}' title='{{item.name}}: {{item.value|floatformat:"-1"}}/{{item.max_value|floatformat:"-1"}}'><div style='width:{{item.percentage}}%;background-color:{{item.color}}'></div></div>{{item.name}}{% endfor %}""")
+
+
+FIELDS = ['name', 'value', 'rate', 'min_value', 'max_value', 'default_value',
+          'default_at', 'min_at', 'max_at']
+
+
+def dict_to_json(item):
+    """ the fields main.attribute_to_json reads, from a legacy state dict """
+    return dict((field, item[field]) for field in FIELDS)
+
+
+def slots_to_json(item):
+    """ the fields main.attribute_to_json reads, from an AttributeState """
+    return dict((field, getattr(item, field)) for field in FIELDS)
+
+
+def legacy_state(attribute_type, name, value, rate, ref_time):
+    """ attribute_state as it was before AttributeState """
+    default_at, min_at, max_at = predict_times(attribute_type, value, rate, ref_time)
+    return {'name': name,
+            'value': value,
+            'color': attribute_type.color,
+            'min_value': attribute_type.min_value,
+            'max_value': attribute_type.max_value,
+            'default_value': attribute_type.default_value,
+            'percentage': 100 * value / attribute_type.max_value,
+            'order': attribute_type.order,
+            'rate': rate,
+            'reference_time': ref_time,
+            'default_at': default_at, 'min_at': min_at, 'max_at': max_at}
+
+
+def build(factory, key, attribute_types, players, now):
+    snapshots = []
+    for i in xrange(players):
+        state = []
+        for attribute_type in attribute_types:
+            value = float((i * 7) % 120)
+            rate = rate_towards_default(attribute_type, value, None)
+            state.append(factory(attribute_type, attribute_type.name, value, rate, now))
+        snapshots.append(sorted(state, key=key))
+    return snapshots
+
+
+def retained_bytes(snapshots, shared):
+    """ bytes held by the snapshots, not counting objects in shared """
+    seen = set(id(o) for o in shared)
+    total = 0
+    stack = list(snapshots)
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.itervalues())
+        elif isinstance(o, list):
+            stack.extend(o)
+        elif hasattr(o, '__slots__'):
+            stack.extend(getattr(o, slot) for slot in o.__slots__)
+    return total
+
+
+def timed(f, repeat=5):
+    """ best of repeat runs, in ms, and the result of the last one """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = f()
+        elapsed = (time.time() - start) * 1e3
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main(players=10000):
+    now = datetime.now()
+    attribute_types = [AttributeType.create('health', recovery='0.1', color='#f00'),
+                       AttributeType.create('energy', recovery='0.5', color='#00f')]
+    # everything the snapshots share: the types and their values, the names
+    shared = [now, None] + attribute_types
+    for attribute_type in attribute_types:
+        shared.extend([attribute_type.name, attribute_type.color, attribute_type.order,
+                       attribute_type.min_value, attribute_type.max_value,
+                       attribute_type.default_value])
+
+    variants = [('dict', legacy_state, lambda x: x['order'], dict_to_json),
+                ('slots', AttributeState, lambda x: x.order, slots_to_json)]
+    print '%d players, %d attributes each' % (players, len(attribute_types))
+    print '%8s %12s %12s %12s %12s' % ('state', 'build (ms)', 'render (ms)', 'json (ms)', 'memory (KB)')
+    for label, factory, key, to_json in variants:
+        build_ms, snapshots = timed(lambda: build(factory, key, attribute_types, players, now))
+        render_ms, _ = timed(lambda: [BAR.render(Context({'attribute_state': s})) for s in snapshots])
+        json_ms, _ = timed(lambda: [[to_json(item) for item in s] for s in snapshots])
+        memory = retained_bytes(snapshots, shared) / 1024.0
+        print '%8s %12.1f %12.1f %12.1f %12.1f' % (label, build_ms, render_ms, json_ms, memory)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,73 @@
+""" compares the cache codec in caching.py with the legacy format
+
+    the legacy format wraps every entity in a ProtoBufObj inside a
+    SerializedList, which the memcache library then pickles.
+    the current format encodes the whole list into one string that memcache
+    stores as is, and decodes it lazily.
+
+    usage: python benchmarks/cache_codec_bench.py [repeat]
+"""
+import sys
+import time
+
+import sdk
+testbed = sdk.activate()
+
+import cPickle
+import caching
+from models import AttributeType, Player
+
+SIZES = [1, 10, 100, 1000]
+
+
+def make_entities(n):
+    entities = []
+    for i in xrange(n):
+        if i % 2:
+            entities.append(AttributeType(key_name='attribute%d' % i,
+                                          name='attribute%d' % i,
+                                          description='benchmark attribute number %d' % i,
+                                          recovery='0.5', decay='1.0'))
+        else:
+            entities.append(Player(key_name='facebook|%d' % i, network='facebook',
+                                   userid=str(i), nickname='player %d' % i))
+    return entities
+
+
+def timed(f, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        result = f()
+    return (time.time() - start) * 1e3 / repeat, result
+
+
+def legacy_encode(entities):
+    return cPickle.dumps(caching.SerializedList(entities), cPickle.HIGHEST_PROTOCOL)
+
+
+def legacy_decode(data):
+    return caching.from_binary(cPickle.loads(data))
+
+
+def main(repeat=50):
+    print '%8s | %10s %10s %10s | %10s %10s %10s %10s' % (
+        'entities', 'legacy B', 'enc ms', 'dec ms',
+        'codec B', 'enc ms', 'index ms', 'dec ms')
+    for n in SIZES:
+        entities = make_entities(n)
+        legacy_enc, legacy = timed(lambda: legacy_encode(entities), repeat)
+        legacy_dec, _ = timed(lambda: legacy_decode(legacy), repeat)
+        codec_enc, codec = timed(lambda: caching.to_binary(entities), repeat)
+        # 'index' only builds the lazy list, 'dec' also decodes every entity
+        codec_index, _ = timed(lambda: caching.from_binary(codec), repeat)
+        codec_dec, _ = timed(lambda: list(caching.from_binary(codec)), repeat)
+        print '%8d | %10d %10.3f %10.3f | %10d %10.3f %10.3f %10.3f' % (
+            n, len(legacy), legacy_enc, legacy_dec,
+            len(codec), codec_enc, codec_index, codec_dec)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
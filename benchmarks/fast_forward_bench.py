@@ -0,0 +1,100 @@
+""" cost of Thespian.fast_forward per attribute
+
+    compares the current fast_forward, which uses formulas compiled once
+    per source text, with the previous implementation, which evaluated the
+    raw formula strings and rebuilt its context on every call.
+
+    it also compares fast forwarding a batch of attributes one at a time
+    with hnh.fast_forward_values, which handles each AttributeType with
+    constant rates in one array pass.
+
+    usage: python benchmarks/fast_forward_bench.py [repeat]
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+
+import sdk
+testbed = sdk.activate()
+
+from models import Player, Attribute, AttributeType, base_ctx
+import hnh
+from hnh import Thespian, timedelta_to_seconds, fast_forward_values
+
+BATCHES = [10, 100, 1000, 10000]
+
+FORMULAS = [('constant', '0.5', '1.0'),
+            ('expression', 'min(0.5, sqrt(4.0) / 4)', 'max(1.0, log(2))')]
+
+
+def legacy_fast_forward(thespian, attribute, ref_time):
+    """ fast_forward as it was before formulas were compiled """
+    elapsed = timedelta_to_seconds(ref_time - attribute.latest_date)
+    attribute_type = thespian.attribute_types[attribute.name]
+    default = attribute_type.default_value
+    latest_value = attribute.latest_value
+    global_ctx = {'__builtins__': None}
+    local_ctx = {'actor': thespian}
+    local_ctx = dict(local_ctx.items() + base_ctx.items())
+    if latest_value < default:
+        new_value = min(latest_value + elapsed * eval(attribute_type.recovery, global_ctx, local_ctx), default)
+    elif latest_value > default:
+        new_value = max(latest_value - elapsed * eval(attribute_type.decay, global_ctx, local_ctx), default)
+    else:
+        new_value = latest_value
+    return {'name': attribute.name,
+            'value': new_value,
+            'color': attribute_type.color,
+            'max_value': attribute_type.max_value,
+            'percentage': 100 * new_value / attribute_type.max_value,
+            'order': attribute_type.order, }
+
+
+def timed(f, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        f()
+    return (time.time() - start) * 1e6 / repeat
+
+
+def main(repeat=20000):
+    AttributeType.create('health', recovery='0.1')
+    AttributeType.create('energy', recovery='0.5')
+    player = Player.get_or_create('facebook', '1', 'benchmark')
+    print '%12s %14s %14s' % ('formula', 'legacy (us)', 'compiled (us)')
+    for label, recovery, decay in FORMULAS:
+        AttributeType.create(label, recovery=recovery, decay=decay)
+        thespian = Thespian(player)
+        now = datetime.now()
+        attribute = Attribute(key_name='benchmark|%s' % label, parent=player, name=label,
+                              latest_value=20.0)
+        attribute.latest_date = now - timedelta(seconds=30)
+        thespian.attribute_types[label] = AttributeType.get_by_key_name(label)
+        legacy = timed(lambda: legacy_fast_forward(thespian, attribute, now), repeat)
+        compiled = timed(lambda: thespian.fast_forward(attribute, now), repeat)
+        print '%12s %14.2f %14.2f' % (label, legacy, compiled)
+
+    print
+    print 'numpy: %s' % (hnh.numpy is not None and hnh.numpy.__version__ or 'not available')
+    print '%12s %14s %14s' % ('attributes', 'one by one (ms)', 'batch (ms)')
+    thespian = Thespian(player)
+    now = datetime.now()
+    for n in BATCHES:
+        attributes = []
+        for i in xrange(n):
+            attribute = Attribute(key_name='benchmark|%d' % i, parent=player,
+                                  name=('health', 'energy')[i % 2], latest_value=float(i % 100))
+            attribute.latest_date = now - timedelta(seconds=i % 600)
+            attributes.append(attribute)
+        actors = [thespian] * n
+        repeat_batch = max(1, repeat / n)
+        single = timed(lambda: [thespian.fast_forward(a, now).value for a in attributes], repeat_batch) / 1e3
+        batch = timed(lambda: fast_forward_values(attributes, actors, thespian.attribute_types, now), repeat_batch) / 1e3
+        print '%12d %14.3f %14.3f' % (n, single, batch)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
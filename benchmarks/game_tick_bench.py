@@ -0,0 +1,107 @@
+""" game tick simulation of the Thespian engine
+
+    creates a population of players, replays a synthetic stream of hurt,
+    heal and steal actions between random players through hnh.act, and
+    renders hnh.get_current_info for the target of each action, as the
+    status page does after an action.
+
+    reports, for acting and for viewing, the operations per second, the
+    p50 and p99 latency and the RPCs made per operation, by service and
+    call. actions rejected by a restriction (not enough energy) are
+    counted separately and included in the act figures, since they cost
+    a round trip too.
+
+    the stubs are in-process, so the latencies mostly measure the app's
+    own cpu time plus stub overhead, and are only comparable between runs
+    on the same machine. the RPC counts are what to watch for regressions.
+
+    usage: python benchmarks/game_tick_bench.py [players] [actions] [--write-behind]
+"""
+import logging
+import random
+import sys
+import time
+from collections import defaultdict
+
+import sdk
+testbed = sdk.activate()
+
+from google.appengine.api import apiproxy_stub_map
+
+from models import Player, AttributeType
+import hnh
+
+ACTIONS = ['hurt', 'heal', 'steal']
+SEED = 1
+
+
+class RPCCounter(object):
+    """ counts RPCs by phase and service.call, while a phase is set """
+    def __init__(self):
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.phase = None
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter', self.hook)
+
+    def hook(self, service, call, request, response):
+        if self.phase:
+            self.counts[self.phase]['%s.%s' % (service, call)] += 1
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def report(label, samples, counts, elapsed):
+    count = len(samples)
+    print '%s: %d in %.2fs, %.1f/s, p50 %.2fms, p99 %.2fms' % (
+        label, count, elapsed, count / elapsed,
+        percentile(samples, 50) * 1e3, percentile(samples, 99) * 1e3)
+    for name in sorted(counts):
+        print '    %-28s %8.2f per op' % (name, counts[name] / float(count))
+
+
+def main(players=50, actions=1000, write_behind=False):
+    logging.getLogger().setLevel(logging.ERROR)
+    hnh.WRITE_BEHIND = write_behind
+    random.seed(SEED)
+    AttributeType.create('health', recovery='0.1', decay='1.0', order=1.0)
+    AttributeType.create('energy', recovery='0.5', decay='1.0', order=2.0)
+    population = [Player.get_or_create('facebook', str(i), 'player %d' % i) for i in xrange(players)]
+
+    counter = RPCCounter()
+    act_times, view_times = [], []
+    rejected = 0
+    act_elapsed = view_elapsed = 0.0
+    for i in xrange(actions):
+        actor, target = random.choice(population), random.choice(population)
+        action = random.choice(ACTIONS)
+
+        counter.phase = 'act'
+        start = time.time()
+        try:
+            hnh.act(actor, target, action, 'tick %d' % i)
+        except hnh.Alert:
+            rejected += 1
+        took = time.time() - start
+        counter.phase = None
+        act_times.append(took)
+        act_elapsed += took
+
+        counter.phase = 'view'
+        start = time.time()
+        hnh.get_current_info(target)
+        took = time.time() - start
+        counter.phase = None
+        view_times.append(took)
+        view_elapsed += took
+
+    print '%d players, %d actions (%d rejected), write behind: %s' % (
+        players, actions, rejected, write_behind)
+    report('act', act_times, counter.counts['act'], act_elapsed)
+    report('get_current_info', view_times, counter.counts['view'], view_elapsed)
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    main(*[int(a) for a in args], write_behind='--write-behind' in sys.argv)
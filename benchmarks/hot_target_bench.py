@@ -0,0 +1,84 @@
+""" many actions queued against one hot target: coalesced or one by one
+
+    queues rounds of hurt and heal actions from a set of actors against a
+    single target (see hnh.queue_action), then applies them either one at
+    a time (hnh.apply_pending) or coalesced (hnh.apply_queued).
+
+    an entity group only sustains about one commit per second, so the
+    number of commits on the target's entity group bounds the throughput
+    against a hot target. the benchmark reports those commits, the actions
+    applied per commit, and the time taken against the in-process stubs.
+
+    coalesced runs are limited to the actors that fit in one cross group
+    transaction with the target (hnh.MAX_XG_GROUPS), so the gain depends
+    on how many distinct players act in the same window.
+
+    usage: python benchmarks/hot_target_bench.py
+"""
+import logging
+import time
+
+import sdk
+testbed = sdk.activate()
+
+from models import Player, AttributeType, PendingAction
+import hnh
+
+# (actors, actions queued by each)
+SCENARIOS = [(1, 20), (2, 20), (4, 10), (10, 4), (20, 2)]
+ACTIONS = ['hurt', 'heal']
+
+target_commits = [0]
+apply_stored = hnh.apply_stored
+
+
+def counting_apply_stored(thespians, now):
+    """ every transaction that applies queued actions calls apply_stored
+        once, and always includes the target """
+    target_commits[0] += 1
+    return apply_stored(thespians, now)
+
+
+def queue(serial, actors, rounds):
+    target = Player.get_or_create('facebook', 'target%d' % serial, 'target')
+    players = [Player.get_or_create('facebook', '%d-%d' % (serial, i), 'actor')
+               for i in xrange(actors)]
+    tokens = []
+    for r in xrange(rounds):
+        for i, actor in enumerate(players):
+            tokens.append(hnh.queue_action(actor, target, ACTIONS[(r + i) % 2], 'bench')['token'])
+    return tokens
+
+
+def main():
+    logging.getLogger().setLevel(logging.ERROR)
+    hnh.apply_stored = counting_apply_stored
+    hnh.APPLY_BATCH = 100
+    AttributeType.create('health', recovery='0.1', decay='1.0', order=1.0)
+    AttributeType.create('energy', recovery='0.5', decay='1.0', order=2.0,
+                         max_value=10000.0, default_value=10000.0)
+    print '%8s %8s %28s %28s' % ('', '', 'one by one', 'coalesced')
+    print '%8s %8s %8s %10s %8s %8s %10s %8s' % ('actors', 'actions', 'commits', 'per commit', 'ms',
+                                              'commits', 'per commit', 'ms')
+    serial = 0
+    for actors, rounds in SCENARIOS:
+        row = [actors, actors * rounds]
+        for coalesce in (False, True):
+            serial += 1
+            tokens = queue(serial, actors, rounds)
+            target_commits[0] = 0
+            start = time.time()
+            if coalesce:
+                applied = hnh.apply_queued(tokens[0])
+            else:
+                applied = 0
+                for token in tokens:
+                    applied += hnh.apply_pending(PendingAction.get_by_key_name(token))
+            elapsed = (time.time() - start) * 1e3
+            assert applied == len(tokens), (applied, len(tokens))
+            row += [target_commits[0], applied / float(target_commits[0]), elapsed]
+        print '%8d %8d %8d %10.1f %8.1f %8d %10.1f %8.1f' % tuple(row)
+
+
+if __name__ == '__main__':
+    main()
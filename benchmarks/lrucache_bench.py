@@ -0,0 +1,55 @@
+""" micro-benchmark for lrucache.LRUCache
+
+    fills caches of increasing size and times get/set on them.
+    latency per operation should stay flat as the cache grows.
+
+    usage: python benchmarks/lrucache_bench.py [ops]
+"""
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lrucache import LRUCache
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+
+
+def bench(size, ops):
+    cache = LRUCache(size=size)
+    for i in xrange(size):
+        cache[i] = i
+    keys = [random.randrange(size) for _ in xrange(ops)]
+
+    start = time.time()
+    for k in keys:
+        cache[k]
+    get_us = (time.time() - start) * 1e6 / ops
+
+    # overwrite existing keys
+    start = time.time()
+    for k in keys:
+        cache[k] = k
+    set_us = (time.time() - start) * 1e6 / ops
+
+    # insert new keys, each one evicting the least recently used record
+    start = time.time()
+    for k in xrange(size, size + ops):
+        cache[k] = k
+    evict_us = (time.time() - start) * 1e6 / ops
+    return get_us, set_us, evict_us
+
+
+def main(ops=100000):
+    print '%10s %12s %12s %12s' % ('entries', 'get (us)', 'set (us)', 'evict (us)')
+    for size in SIZES:
+        print '%10d %12.3f %12.3f %12.3f' % ((size,) + bench(size, ops))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
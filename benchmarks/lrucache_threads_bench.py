@@ -0,0 +1,71 @@
+""" multithreaded stress benchmark for lrucache.ShardedLRUCache
+
+    runs a random mix of reads, writes and deletes from several threads
+    at once, checks that the cache is still consistent afterwards, and
+    compares throughput with a single global lock (a one-shard cache).
+
+    usage: python benchmarks/lrucache_threads_bench.py [ops per thread]
+"""
+import os
+import sys
+import random
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lrucache import ShardedLRUCache, CacheKeyError
+
+THREADS = [1, 2, 4, 8, 16]
+SIZE = 10000
+KEYS = 3 * SIZE
+
+
+def worker(cache, ops, seed):
+    rnd = random.Random(seed)
+    for _ in xrange(ops):
+        key = rnd.randrange(KEYS)
+        op = rnd.random()
+        try:
+            if op < 0.7:
+                cache[key]
+            elif op < 0.95:
+                cache[key] = 'value %d' % key
+            else:
+                del cache[key]
+        except CacheKeyError:
+            pass
+
+
+def check(cache):
+    keys = list(cache)
+    assert len(keys) == len(set(keys)) == len(cache), 'duplicate or lost records'
+    assert len(cache) <= cache.size + cache.shards, 'cache exceeded its size'
+    assert cache.bytes == sum(len(cache[k]) for k in keys), 'byte count drifted'
+    assert cache.bytes <= cache.max_bytes + cache.shards * 16, 'cache exceeded its byte budget'
+
+
+def run(shards, threads, ops):
+    cache = ShardedLRUCache(size=SIZE, max_bytes=SIZE * 10, sizeof=len, shards=shards)
+    workers = [threading.Thread(target=worker, args=(cache, ops, i)) for i in xrange(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    check(cache)
+    return threads * ops / elapsed
+
+
+def main(ops=50000):
+    print '%8s %18s %18s' % ('threads', 'global lock op/s', '16 shards op/s')
+    for threads in THREADS:
+        print '%8d %18.0f %18.0f' % (threads, run(1, threads, ops), run(16, threads, ops))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,37 @@
+""" sets up the app engine sdk and its service stubs for benchmarks
+
+    import this module before any application module:
+
+        import sdk
+        testbed = sdk.activate()
+
+    the sdk is looked for in ../google_appengine, or in $APPENGINE_SDK.
+"""
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+SDK = os.environ.get('APPENGINE_SDK', os.path.join(ROOT, 'google_appengine'))
+
+sys.path[0:0] = [SDK, SRC]
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import testbed as testbed_module
+from google.appengine.datastore import datastore_stub_util
+
+
+def activate():
+    """ activates a testbed with the stubs used by the app (datastore,
+        memcache and task queue)
+        the datastore behaves like the high replication datastore, with
+        queries always consistent, so that cross-group transactions work
+    """
+    testbed = testbed_module.Testbed()
+    testbed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    testbed.init_datastore_v3_stub(consistency_policy=policy)
+    testbed.init_memcache_stub()
+    testbed.init_taskqueue_stub(root_path=SRC)
+    return testbed
@@ -0,0 +1,322 @@
+""" a small, restricted language for the scripts of ActionTypes
+
+    scripts are written in python syntax, but only a whitelist of
+    operations is accepted. a script is parsed with the ast module and
+    compiled once into a tree of closures, which run_script then calls
+    directly: there is no exec, no builtins and no attribute access
+    other than the forms below.
+
+    statements:
+        name = expression
+        if expression: ... elif ...: ... else: ...
+        actor.restrict('energy')            (or target)
+        actor.add_effect('energy',expression)
+        pass
+
+    expressions:
+        numbers, local names assigned earlier in the script
+        the functions and constants the script is compiled with
+        + - * / // % ** and unary + - not
+        comparisons, and, or, x if condition else y
+        actor.attributes['energy'].latest_value     (or target)
+
+    attribute names must be string literals, so the compiler knows which
+    attributes of the actor and the target a script can read and change
+    before it runs (see CompiledScript.attribute_names).
+    there are no loops or function definitions, so every script ends.
+    numbers are all floats, so arithmetic cannot build huge integers: it
+    overflows to inf, and effects must be finite numbers.
+"""
+import ast
+import math
+import operator
+
+
+class ScriptError(ValueError):
+    pass
+
+
+ROLES = ('actor','target')
+INFINITY = float('inf')
+
+def safe_pow(a,b):
+    """ ** in floating point, so that huge results overflow rather than
+        take unbounded time and memory to compute """
+    try:
+        return math.pow(a,b)
+    except (OverflowError,ValueError), e:
+        raise ScriptError('%s ** %s: %s' % (a,b,e))
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.div,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: safe_pow,
+    }
+
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+    }
+
+COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    }
+
+
+class CompiledScript(object):
+    """ a script compiled to closures. run it with run(actor,target)
+        reads and writes are sets of (role,attribute name): the attributes
+        the script may read or restrict, and those it may add effects to
+    """
+    def __init__(self,source,statements,reads,writes):
+        self.source = source
+        self.statements = statements
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+
+    def attribute_names(self,*roles):
+        """ names of every attribute of the given roles that the script
+            may read or change, whichever branches it takes """
+        return sorted(set(name for role,name in self.reads | self.writes if role in roles))
+
+    def run(self,actor,target):
+        env = {'actor': actor, 'target': target}
+        try:
+            for statement in self.statements:
+                statement(env)
+        except ScriptError:
+            raise
+        except (ArithmeticError,TypeError,ValueError), e:
+            raise ScriptError(str(e))
+
+    def __repr__(self):
+        return '<CompiledScript %r>' % self.source
+
+
+class Compiler(object):
+    """ turns the ast of a script into closures of one argument, env: the
+        dict of the script's local variables, with the two Thespians
+        under 'actor' and 'target'
+    """
+    def __init__(self,functions):
+        self.functions = functions
+        self.assigned = set()
+        self.reads = set()
+        self.writes = set()
+
+    def error(self,node,message):
+        raise ScriptError('line %s: %s' % (getattr(node,'lineno','?'),message))
+
+    def compile(self,source):
+        try:
+            tree = ast.parse(source.strip(),'<action script>','exec')
+        except SyntaxError, e:
+            raise ScriptError('line %s: %s' % (e.lineno,e.msg))
+        statements = self.block(tree.body)
+        return CompiledScript(source,statements,self.reads,self.writes)
+
+    # statements
+
+    def block(self,nodes):
+        return [self.statement(node) for node in nodes if not isinstance(node,ast.Pass)]
+
+    def statement(self,node):
+        if isinstance(node,ast.Assign):
+            return self.assignment(node)
+        if isinstance(node,ast.If):
+            return self.conditional(node)
+        if isinstance(node,ast.Expr) and isinstance(node.value,ast.Call):
+            return self.effect(node.value)
+        self.error(node,'%s statements are not allowed' % node.__class__.__name__)
+
+    def assignment(self,node):
+        if len(node.targets) != 1 or not isinstance(node.targets[0],ast.Name):
+            self.error(node,'only assignments to a single name are allowed')
+        name = node.targets[0].id
+        if name in ROLES or name in self.functions:
+            self.error(node,'%s cannot be assigned to' % name)
+        value = self.expression(node.value)
+        self.assigned.add(name)
+        def assign(env):
+            env[name] = value(env)
+        return assign
+
+    def conditional(self,node):
+        test = self.expression(node.test)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse)
+        def conditional(env):
+            for statement in body if test(env) else orelse:
+                statement(env)
+        return conditional
+
+    def effect(self,node):
+        """ actor.add_effect(name,amount) or actor.restrict(name) """
+        role,method = self.role_method(node)
+        if method == 'add_effect':
+            if len(node.args) != 2:
+                self.error(node,'add_effect takes an attribute name and an amount')
+            name = self.attribute_name(node.args[0])
+            amount = self.expression(node.args[1])
+            self.writes.add((role,name))
+            def add_effect(env):
+                value = amount(env)
+                if value != value or value in (INFINITY,-INFINITY):
+                    raise ScriptError('the effect on %s %s is not a finite number' % (role,name))
+                env[role].add_effect(name,value)
+            return add_effect
+        if method == 'restrict':
+            if len(node.args) != 1:
+                self.error(node,'restrict takes an attribute name')
+            name = self.attribute_name(node.args[0])
+            self.reads.add((role,name))
+            def restrict(env):
+                env[role].restrict(name)
+            return restrict
+        self.error(node,'%s.%s() is not allowed' % (role,method))
+
+    def role_method(self,node):
+        func = node.func
+        if (not isinstance(func,ast.Attribute) or not isinstance(func.value,ast.Name)
+            or func.value.id not in ROLES):
+            self.error(node,'only actor and target methods can be called as statements')
+        if node.keywords or node.starargs or node.kwargs:
+            self.error(node,'only positional arguments are allowed')
+        return func.value.id,func.attr
+
+    def attribute_name(self,node):
+        if not isinstance(node,ast.Str):
+            self.error(node,'attribute names must be string literals')
+        return node.s
+
+    # expressions
+
+    def expression(self,node):
+        if isinstance(node,ast.Num):
+            if isinstance(node.n,complex):
+                self.error(node,'complex numbers are not allowed')
+            value = float(node.n)
+            return lambda env: value
+        if isinstance(node,ast.Name):
+            return self.name(node)
+        if isinstance(node,ast.BinOp):
+            op = self.operator(BINARY_OPERATORS,node.op,node)
+            left,right = self.expression(node.left),self.expression(node.right)
+            return lambda env: op(left(env),right(env))
+        if isinstance(node,ast.UnaryOp):
+            op = self.operator(UNARY_OPERATORS,node.op,node)
+            operand = self.expression(node.operand)
+            return lambda env: op(operand(env))
+        if isinstance(node,ast.BoolOp):
+            return self.boolean(node)
+        if isinstance(node,ast.Compare):
+            return self.comparison(node)
+        if isinstance(node,ast.IfExp):
+            test,body,orelse = [self.expression(n) for n in (node.test,node.body,node.orelse)]
+            return lambda env: body(env) if test(env) else orelse(env)
+        if isinstance(node,ast.Call):
+            return self.call(node)
+        if isinstance(node,ast.Attribute):
+            return self.attribute_value(node)
+        self.error(node,'%s expressions are not allowed' % node.__class__.__name__)
+
+    def operator(self,table,op,node):
+        try:
+            return table[op.__class__]
+        except KeyError:
+            self.error(node,'the %s operator is not allowed' % op.__class__.__name__)
+
+    def name(self,node):
+        name = node.id
+        if name in self.assigned:
+            def local(env):
+                try:
+                    return env[name]
+                except KeyError:
+                    raise ScriptError('%s is used before it is assigned' % name)
+            return local
+        if isinstance(self.functions.get(name),(int,long,float)):
+            value = float(self.functions[name])
+            return lambda env: value
+        self.error(node,'unknown name %s' % name)
+
+    def boolean(self,node):
+        values = [self.expression(n) for n in node.values]
+        if isinstance(node.op,ast.And):
+            def all_of(env):
+                result = True
+                for value in values:
+                    result = value(env)
+                    if not result:
+                        break
+                return result
+            return all_of
+        def any_of(env):
+            result = False
+            for value in values:
+                result = value(env)
+                if result:
+                    break
+            return result
+        return any_of
+
+    def comparison(self,node):
+        left = self.expression(node.left)
+        ops = [self.operator(COMPARISONS,op,node) for op in node.ops]
+        comparators = [self.expression(n) for n in node.comparators]
+        def compare(env):
+            a = left(env)
+            for op,comparator in zip(ops,comparators):
+                b = comparator(env)
+                if not op(a,b):
+                    return False
+                a = b
+            return True
+        return compare
+
+    def call(self,node):
+        if not isinstance(node.func,ast.Name) or not callable(self.functions.get(node.func.id)):
+            self.error(node,'only the math functions can be called in expressions')
+        if node.keywords or node.starargs or node.kwargs:
+            self.error(node,'only positional arguments are allowed')
+        function = self.functions[node.func.id]
+        args = [self.expression(n) for n in node.args]
+        return lambda env: function(*[arg(env) for arg in args])
+
+    def attribute_value(self,node):
+        """ actor.attributes['energy'].latest_value """
+        subscript = node.value
+        if (node.attr != 'latest_value' or not isinstance(subscript,ast.Subscript)
+            or not isinstance(subscript.value,ast.Attribute)
+            or subscript.value.attr != 'attributes'
+            or not isinstance(subscript.value.value,ast.Name)
+            or subscript.value.value.id not in ROLES
+            or not isinstance(subscript.slice,ast.Index)):
+            self.error(node,"the only attribute that can be read is actor.attributes['name'].latest_value")
+        role = subscript.value.value.id
+        name = self.attribute_name(subscript.slice.value)
+        self.reads.add((role,name))
+        def latest_value(env):
+            try:
+                return env[role].attributes[name].latest_value
+            except KeyError:
+                raise ScriptError('%s has no %s attribute' % (role,name))
+        return latest_value
+
+
+def compile_script(source,functions):
+    """ compiles the source of an action script, allowing calls to the
+        callables in functions and reads of its other values (constants)
+        raises ScriptError if the script uses anything not allowed
+    """
+    return Compiler(functions).compile(source)
@@ -1,11 +1,24 @@
 from google.appengine.api import memcache
+from google.appengine.api import datastore
 from google.appengine.datastore import entity_pb 
 from google.appengine.ext import db
 
+import cPickle
+import datetime
 import json
-from types import CodeType
+import logging
+import marshal
+import random
+import struct
+import sys
+import time
+import uuid
+import zlib
+from types import CodeType, ModuleType, FunctionType, BuiltinFunctionType
 
 
+# legacy cache format: wrapper objects pickled by the memcache library
+# to_binary no longer writes these, but from_binary still reads them
 class Serialized(object):
     def deserialize(self):
         raise NotImplementedError
@@ -45,110 +58,750 @@ class SerializedList(Serialized):
     def deserialize(self):
         entities = []
         for obj in self.vals:
-            try:
+            if isinstance(obj, Serialized):
                 entities.append(obj.deserialize())
-            except AttributeError:
+            else:
                 entities.append(obj)
-            return entities
+        return entities
+
+
+# cache codec
+# every value is encoded into a single string, which memcache stores as is.
+# the first byte says how the rest is encoded:
+#   'E' - one entity, as an encoded EntityProto
+#   'L' - a list of entities (or None): a kind table, then one
+#         length-prefixed EntityProto per item
+#   'M' - a marshaled code object
+#   'P' - anything else, pickled
+#   'Z' - any of the above, compressed with zlib
+#   'K' - a value too big for one memcache item, stored in chunks
+TAG_ENTITY = 'E'
+TAG_ENTITY_LIST = 'L'
+TAG_CODE = 'M'
+TAG_PICKLE = 'P'
+TAG_COMPRESSED = 'Z'
+TAG_CHUNKED = 'K'
+
+# encoded values larger than this many bytes are compressed
+COMPRESS_THRESHOLD = 16 * 1024
+# largest string stored as a single memcache item, leaving room for the key
+MAX_ITEM_BYTES = memcache.MAX_VALUE_SIZE - 1024
+
+# totals over every value encoded by this instance, see codec_stats()
+_codec_totals = {'values': 0, 'raw_bytes': 0, 'stored_bytes': 0,
+                 'compressed': 0, 'chunked': 0}
+
+_count = struct.Struct('!I')
+_kind_name = struct.Struct('!H')
+_item_header = struct.Struct('!HI') # kind index, length
+NO_ENTITY = 0xFFFF # kind index used for None items
+
+def entity_to_pb(entity):
+    return db.model_to_protobuf(entity).Encode()
+
+def entity_from_pb(model_class,data):
+    return model_class.from_entity(datastore.Entity._FromPb(entity_pb.EntityProto(data)))
+
+def encode_entity_list(entities):
+    kinds = []
+    kind_index = {}
+    items = []
+    for entity in entities:
+        if entity is None:
+            items.append(_item_header.pack(NO_ENTITY,0))
+            continue
+        kind = entity.kind()
+        if kind not in kind_index:
+            kind_index[kind] = len(kinds)
+            kinds.append(kind)
+        data = entity_to_pb(entity)
+        items.append(_item_header.pack(kind_index[kind],len(data)))
+        items.append(data)
+    header = [TAG_ENTITY_LIST,_count.pack(len(kinds))]
+    for kind in kinds:
+        kind = kind.encode('utf-8')
+        header.append(_kind_name.pack(len(kind)))
+        header.append(kind)
+    header.append(_count.pack(len(entities)))
+    return ''.join(header + items)
+
+class LazyEntityList(object):
+    """ read-only list of entities decoded from the cache
+        the blob is indexed up front; each entity is only decoded from its
+        protobuf the first time it is accessed
+    """
+    def __init__(self,data):
+        offset = 1
+        (num_kinds,) = _count.unpack_from(data,offset)
+        offset += _count.size
+        classes = []
+        for i in xrange(num_kinds):
+            (length,) = _kind_name.unpack_from(data,offset)
+            offset += _kind_name.size
+            classes.append(db.class_for_kind(data[offset:offset+length].decode('utf-8')))
+            offset += length
+        (num_items,) = _count.unpack_from(data,offset)
+        offset += _count.size
+        self._data = data
+        self._classes = classes
+        self._index = []
+        for i in xrange(num_items):
+            kind,length = _item_header.unpack_from(data,offset)
+            offset += _item_header.size
+            self._index.append((kind,offset,length))
+            offset += length
+        self._entities = [None] * num_items
+        self._decoded = [False] * num_items
+
+    def _entity(self,i):
+        if not self._decoded[i]:
+            kind,offset,length = self._index[i]
+            if kind != NO_ENTITY:
+                self._entities[i] = entity_from_pb(self._classes[kind],self._data[offset:offset+length])
+            self._decoded[i] = True
+        return self._entities[i]
+
+    def undecoded_size(self):
+        """ estimated bytes the entities not decoded yet will hold once they
+            are, from the lengths of their protobufs """
+        size = 0
+        for i,(kind,offset,length) in enumerate(self._index):
+            if kind != NO_ENTITY and not self._decoded[i]:
+                size += DECODED_ENTITY_BYTES + DECODED_BYTES_PER_PB_BYTE * length
+        return size
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self._entity(j) for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('list index out of range')
+        return self._entity(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._entity(i)
+
+    def __eq__(self,other):
+        return list(self) == list(other)
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __repr__(self):
+        return '<LazyEntityList of %d>' % len(self)
+
+def is_entity_list(data):
+    return isinstance(data,(list,LazyEntityList)) and len(data) > 0 and \
+        all(x is None or isinstance(x,db.Model) for x in data) and \
+        any(x is not None for x in data)
 
 # functions to (de)serialise objects to be stored in memcached
-def to_binary(data):
-    """ compresses entities or lists of entities for caching.
+def to_binary(data,compress_threshold=None):
+    """ encodes data into a string for caching, in a single pass.
+        encodings longer than compress_threshold (COMPRESS_THRESHOLD by
+        default) are compressed when that makes them smaller.
 
     Args: 
         data - arbitrary data input, on its way to memcache
+        compress_threshold - size in bytes above which to compress
     """ 
     if isinstance(data, db.Model):
-        return ProtoBufObj(data)
+        encoded = TAG_ENTITY + entity_to_pb(data)
     elif isinstance(data, CodeType):
-        return MarshaledCodeObj(data)
-    elif isinstance(data,list) and any(isinstance(x, db.Model) for x in data):
-        # list of entities
-        entities = []
-        for obj in data:
-            # if item is entity, protobuf it.
-            if isinstance(obj, db.Model):
-                entities.append(ProtoBufObj(obj))
-            # if it's a code object, marshal it
-            elif isinstance(obj, CodeType):
-                entities.append(MarshaledCodeObj(obj))
-            else:
-                entities.append(obj)
-        return SerializedList(entities)
-    else: # return data as is, will be pickled by memcache library
-        return data
+        encoded = TAG_CODE + marshal.dumps(data)
+    elif is_entity_list(data):
+        encoded = encode_entity_list(data)
+    else:
+        encoded = TAG_PICKLE + cPickle.dumps(data,cPickle.HIGHEST_PROTOCOL)
+    if compress_threshold is None:
+        compress_threshold = COMPRESS_THRESHOLD
+    _codec_totals['values'] += 1
+    _codec_totals['raw_bytes'] += len(encoded)
+    if len(encoded) > compress_threshold:
+        compressed = TAG_COMPRESSED + zlib.compress(encoded)
+        if len(compressed) < len(encoded):
+            _codec_totals['compressed'] += 1
+            encoded = compressed
+    _codec_totals['stored_bytes'] += len(encoded)
+    return encoded
 
 def from_binary(data):
-    """ decompresses entities or lists from cache.
+    """ decodes data read from the cache.
+        lists of entities come back as a LazyEntityList.
 
     Args: 
         data - arbitrary data input from memcache
     """ 
+    if isinstance(data, str) and data:
+        tag = data[0]
+        if tag == TAG_COMPRESSED:
+            data = zlib.decompress(buffer(data,1))
+            tag = data[0]
+        if tag == TAG_PICKLE:
+            return cPickle.loads(data[1:])
+        elif tag == TAG_ENTITY:
+            return db.model_from_protobuf(entity_pb.EntityProto(data[1:]))
+        elif tag == TAG_ENTITY_LIST:
+            return LazyEntityList(data)
+        elif tag == TAG_CODE:
+            return marshal.loads(data[1:])
     if isinstance(data, Serialized):
         return data.deserialize()
     else: # return data as is 
         return data
 
+def codec_stats():
+    """ how much to_binary has encoded, and how well it compressed """
+    stats = dict(_codec_totals)
+    if stats['raw_bytes']:
+        stats['compression_ratio'] = float(stats['stored_bytes']) / stats['raw_bytes']
+    else:
+        stats['compression_ratio'] = 1.0
+    return stats
+
+# memcache items are limited to MAX_ITEM_BYTES, so bigger encodings are
+# split over several items. the value stored under the key itself is then
+# a manifest: the tag, the number of chunks and a token unique to this write,
+# which keeps chunks of different writes from being mixed up
+_manifest = struct.Struct('!I32s')
+
+def split_chunks(key,data):
+    """ returns the mapping of memcache items needed to store data under key """
+    if len(data) <= MAX_ITEM_BYTES:
+        return {key: data}
+    _codec_totals['chunked'] += 1
+    token = uuid.uuid4().hex
+    chunk_size = MAX_ITEM_BYTES
+    chunks = [data[i:i+chunk_size] for i in xrange(0,len(data),chunk_size)]
+    items = {key: TAG_CHUNKED + _manifest.pack(len(chunks),token)}
+    for i,chunk in enumerate(chunks):
+        items[chunk_key(key,token,i)] = chunk
+    return items
+
+def chunk_key(key,token,i):
+    return '%s|%s|%d' % (key,token,i)
+
+def cache_set_multi(mapping,time=0):
+    """ encodes and stores several values with one memcache call,
+        chunking any value that is too big for a single item """
+    items = {}
+    for key,value in mapping.iteritems():
+        items.update(split_chunks(key,to_binary(value)))
+    return memcache.set_multi(items,time=time)
+
+def cache_get_multi(keys):
+    """ reads and decodes several values, reassembling chunked values with
+        at most one more memcache call. returns a dict of the keys found """
+    found = memcache.get_multi(keys)
+    chunked = {}
+    for key,data in found.items():
+        if isinstance(data,str) and data[:1] == TAG_CHUNKED:
+            count,token = _manifest.unpack_from(data,1)
+            chunked[key] = [chunk_key(key,token,i) for i in xrange(count)]
+            del found[key]
+    if chunked:
+        chunks = memcache.get_multi([k for ck in chunked.values() for k in ck])
+        for key,chunk_keys in chunked.iteritems():
+            if all(k in chunks for k in chunk_keys):
+                found[key] = ''.join(chunks[k] for k in chunk_keys)
+    results = {}
+    for key,data in found.iteritems():
+        results[key] = from_binary(data)
+    return results
+
+def cache_set(key,value,time=0):
+    return cache_set_multi({key: value},time)
+
+def cache_get(key):
+    return cache_get_multi([key]).get(key)
+
 
 # higher level functions using memcached
 import urllib2
 import urllib
 
+# dogpile protection
+# when a hot value is missing, only the first caller to take a short lease
+# (a memcache add) recomputes it. the others are served the previous value
+# if there is one, or poll for the new value while the lease is held.
+LEASE_SECONDS = 10 # lease expiry, in case its holder dies
+LEASE_POLL_INTERVAL = 0.05
+LEASE_POLLS = 20
+
+_lease_totals = {'leases': 0, 'recomputations_avoided': 0,
+                 'served_previous': 0, 'wait_timeouts': 0}
+
+def lease_stats():
+    return dict(_lease_totals)
+
+def compute_with_lease(key,compute,read,store,previous=None):
+    """ computes and stores the value for key, unless another caller
+        already holds the lease to do so.
+
+    Args:
+        key - cache key of the value
+        compute - f() -> value, the expensive computation
+        read - f() -> value or None, rereads the value from the cache
+        store - f(value), writes the value to the cache
+        previous - f() -> an outdated value that may be served instead of
+                   waiting, or None. only called if another caller holds
+                   the lease
+    """
+    lease_key = 'lease:%s' % key
+    if not memcache.add(lease_key,1,time=LEASE_SECONDS):
+        value = previous and previous()
+        if value is not None:
+            _lease_totals['served_previous'] += 1
+            _lease_totals['recomputations_avoided'] += 1
+            return value
+        for i in xrange(LEASE_POLLS):
+            time.sleep(LEASE_POLL_INTERVAL)
+            value = read()
+            if value is not None:
+                _lease_totals['recomputations_avoided'] += 1
+                return value
+            if memcache.get(lease_key) is None:
+                # the holder finished (or gave up) without a value to share
+                break
+        else:
+            _lease_totals['wait_timeouts'] += 1
+        value = compute()
+        store(value)
+        return value
+    _lease_totals['leases'] += 1
+    try:
+        value = compute()
+        store(value)
+    finally:
+        memcache.delete(lease_key)
+    return value
+
 def cached_json_urlopen(url,duration=None):
     key = 'URL(%s)' % url
-    result = from_binary(memcache.get(key))
+    result = cache_get(key)
     if not result:
-        result = json.loads(urllib2.urlopen(url).read())        
-        memcache.set(key,to_binary(result))
+        result = compute_with_lease(key,
+                                    lambda: json.loads(urllib2.urlopen(url).read()),
+                                    lambda: cache_get(key),
+                                    lambda value: cache_set(key,value,duration or 0))
     return result
 
+# memory accounting for the local cache
+_unsized_types = (type, ModuleType, FunctionType, BuiltinFunctionType, CodeType)
+# measured as they are, without looking inside
+_flat_types = frozenset([str, unicode, int, long, float, bool, type(None), datetime.datetime])
+
+# a Key and its protobuf, for a path of a couple of elements. keys are
+# counted at this fixed size rather than by walking the protobuf, which
+# costs more than the cache insert it is charged to
+KEY_BYTES = 1024
+# what an entity decoded from a protobuf holds, as estimated by entity_size:
+# the entity, its attribute dict and key, plus its property values
+DECODED_ENTITY_BYTES = 2048
+DECODED_BYTES_PER_PB_BYTE = 3
+
+def entity_size(entity,_seen):
+    """ an entity by its own data: its key and its property values.
+        its parent and the entities its references resolve to are cached
+        under their own keys, so they are not counted """
+    size = sys.getsizeof(entity) + sys.getsizeof(entity.__dict__)
+    if entity.has_key():
+        size += KEY_BYTES
+    for prop in entity.properties().itervalues():
+        # the stored value: a Key, for a ReferenceProperty
+        size += estimate_size(getattr(entity,prop._attr_name(),None),_seen)
+    for name in entity.dynamic_properties():
+        size += estimate_size(getattr(entity,name),_seen)
+    return size
+
+def estimate_size(obj,_seen=None):
+    """ estimates the memory held by an object, in bytes.
+
+    Follows containers and instance attributes, counting shared objects
+    once. Classes, modules and functions are not counted. Entities and
+    keys are measured by their own data (see entity_size), and a
+    LazyEntityList as if all its entities were decoded.
+
+    Args:
+        obj - any python object
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen or isinstance(obj, _unsized_types):
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if type(obj) in _flat_types or isinstance(obj, basestring):
+        return size
+    if isinstance(obj, db.Key):
+        return KEY_BYTES
+    if isinstance(obj, db.Model):
+        return entity_size(obj,_seen)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += estimate_size(k,_seen) + estimate_size(v,_seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += estimate_size(item,_seen)
+    elif isinstance(obj, LazyEntityList):
+        size += obj.undecoded_size()
+    if hasattr(obj, '__dict__'):
+        size += estimate_size(obj.__dict__,_seen)
+    return size
+
+
 # 2 level cache
-from lrucache import LRUCache, CacheKeyError
-from random import random
+from lrucache import ShardedLRUCache, CacheKeyError
+import re
+import threading
+
+def version_seed():
+    """ the value a version counter missing from memcache starts at.
+        random rather than the clock, which a counter bumped more than
+        once a second, or reseeded by an instance whose clock is behind,
+        could come back to """
+    return random.getrandbits(62)
+
+def fetch_versions(names,key_prefix):
+    """ reads several version counters from memcache in one batch
+        returns a dict of version by name
+    """
+    names = list(names)
+    versions = memcache.get_multi(names,key_prefix=key_prefix)
+    missing = [n for n in names if n not in versions]
+    if missing:
+        # not 0, so that a counter evicted from memcache does not come
+        # back at a value used before
+        seed = version_seed()
+        memcache.add_multi(dict((n,seed) for n in missing),key_prefix=key_prefix)
+        found = memcache.get_multi(missing,key_prefix=key_prefix)
+        for n in missing:
+            versions[n] = found.get(n,seed)
+    return versions
+
+def bump_versions(names,key_prefix):
+    """ increments several version counters in one batch, so that anything
+        cached under their previous versions is never read again
+        returns a dict of the new version by name, missing any that
+        memcache failed to increment
+    """
+    names = list(names)
+    if not names:
+        return {}
+    versions = memcache.offset_multi(dict((n,1) for n in names),key_prefix=key_prefix,
+                                     initial_value=version_seed())
+    return dict((n,v) for n,v in versions.iteritems() if v is not None)
+
+class LocalEntry(object):
+    """ a value held in the local tier, with its expiry time and the
+        generation of its key prefix when it was stored """
+    __slots__ = ('value', 'ttl', 'expires', 'refreshing', 'generation')
+    def __init__(self, value, ttl, generation):
+        self.value = value
+        self.ttl = ttl
+        self.expires = time.time() + ttl
+        self.refreshing = False
+        self.generation = generation
+
+def entry_size(entry):
+    return estimate_size(entry.value)
+
+_prefix_separator = re.compile(r'[(.]')
+
+def key_prefix(key):
+    """ the namespace of a cache key: 'AttributeType(health)' and
+        'AttributeType.all()' both belong to 'AttributeType' """
+    return _prefix_separator.split(key,1)[0]
 
 class TwoLevelCache(object):
     '''
         uses both a simple LRUCache and Memcached
+
+        the local ShardedLRUCache is safe to share between the threads of
+        an instance. it is bounded both by number of entries (size) and,
+        if max_bytes is given, by the estimated memory of the cached values
+
+        each local entry lives for its own ttl (seconds), after which it is
+        reloaded from memcache. for stale_ttl seconds past its expiry the
+        old value is still served to other callers while a single caller
+        refetches it, so a hot key does not send every request to memcache
+        at once.
+
+        every key prefix (see key_prefix) has a generation number held in
+        memcache. entries are stored under their prefix's generation, so
+        invalidate_prefix() drops a whole prefix on every instance by
+        bumping it. generations are read in one batch the first time the
+        cache is used in a request (see begin_request/CacheMiddleware), or
+        every generation_ttl seconds outside of requests.
+
+        within a request, every value looked up or stored is also kept in a
+        per-request memo dict that is consulted before the local tier, so
+        repeated lookups skip the LRU and expiry checks altogether.
     '''
-    def __init__(self,size=32000):
-        self.cache = LRUCache(size=size)
+    def __init__(self,size=32000,max_bytes=None,ttl=60,stale_ttl=30,generation_ttl=1,shards=16):
+        if max_bytes is None:
+            self.cache = ShardedLRUCache(size=size,shards=shards)
+        else:
+            self.cache = ShardedLRUCache(size=size,max_bytes=max_bytes,sizeof=entry_size,shards=shards)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.generation_ttl = generation_ttl
+        self.prefixes = set()
+        self.request = threading.local()
+        self.refresh_lock = threading.Lock()
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.generation_misses = 0
+
+    def begin_request(self):
+        """ generations will be reread on the next use of the cache,
+            and lookups are memoized until end_request """
+        self.request.generations = None
+        self.request.in_request = True
+        self.request.memo = {}
+        self.request.memo_hits = 0
+        self.request.memo_misses = 0
+
+    def end_request(self):
+        """ clears the request memo and returns its stats """
+        stats = self.request_stats()
+        self.request.generations = None
+        self.request.in_request = False
+        self.request.memo = None
+        self.request.memo_hits = 0
+        self.request.memo_misses = 0
+        return stats
+
+    def request_stats(self):
+        """ memo hits and misses for the current request """
+        memo = getattr(self.request,'memo',None)
+        return {'memo_hits': getattr(self.request,'memo_hits',0),
+                'memo_misses': getattr(self.request,'memo_misses',0),
+                'memo_entries': len(memo) if memo else 0,
+                }
+
+    def fetch_generations(self,prefixes):
+        """ reads the generations of several prefixes in one batch """
+        return fetch_versions(prefixes,'gen:')
+
+    def generation(self,prefix):
+        """ the current generation of a key prefix, as seen by this request """
+        request = self.request
+        generations = getattr(request,'generations',None)
+        if generations is None or (not getattr(request,'in_request',False) and
+                                   time.time() > request.checked + self.generation_ttl):
+            self.prefixes.add(prefix)
+            generations = request.generations = self.fetch_generations(self.prefixes)
+            request.checked = time.time()
+        elif prefix not in generations:
+            self.prefixes.add(prefix)
+            generations.update(self.fetch_generations([prefix]))
+        return generations[prefix]
+
+    def invalidate_prefix(self,prefix):
+        """ invalidates every key under prefix, on all instances """
+        generation = memcache.incr('gen:%s' % prefix,initial_value=version_seed())
+        generations = getattr(self.request,'generations',None)
+        if generations is not None and generation is not None:
+            generations[prefix] = generation
+        memo = getattr(self.request,'memo',None)
+        if memo:
+            for key in [k for k in memo if key_prefix(k) == prefix]:
+                del memo[key]
+
+    def memcache_key(self,key,generation):
+        return '%s#%d' % (key,generation)
   
     def get(self,key):
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self,keys):
+        """ looks keys up in the local tier, then fetches all the misses with
+            a single memcache call. returns a dict of the keys found """
+        results = {}
+        misses = {} # memcache key -> (key, generation, expired entry)
+        now = time.time()
+        memo = getattr(self.request,'memo',None)
+        for key in keys:
+            if memo is not None:
+                if key in memo:
+                    self.request.memo_hits += 1
+                    results[key] = memo[key]
+                    continue
+                self.request.memo_misses += 1
+            generation = self.generation(key_prefix(key))
+            try:
+                entry = self.cache[key]
+            except CacheKeyError:
+                entry = None
+            if entry is not None and entry.generation != generation:
+                # the prefix was invalidated since this entry was stored
+                self.generation_misses += 1
+                try:
+                    del self.cache[key]
+                except CacheKeyError:
+                    pass # another thread got there first
+                entry = None
+            if entry is not None:
+                if now < entry.expires:
+                    results[key] = entry.value
+                    continue
+                self.refresh_lock.acquire()
+                try:
+                    stale = entry.refreshing and now < entry.expires + self.stale_ttl
+                    # otherwise this caller refreshes the entry
+                    entry.refreshing = True
+                finally:
+                    self.refresh_lock.release()
+                if stale:
+                    # another caller is already refetching this key
+                    self.stale_hits += 1
+                    results[key] = entry.value
+                    continue
+                self.refreshes += 1
+            misses[self.memcache_key(key,generation)] = (key,generation,entry)
+        if misses:
+            found = cache_get_multi(misses.keys())
+            for mkey,result in found.iteritems():
+                if result is None:
+                    continue
+                key,generation,entry = misses[mkey]
+                if entry is not None:
+                    self.set_local(key,result,entry.ttl,generation)
+                else:
+                    self.set_local(key,result,None,generation)
+                results[key] = result
+        if memo is not None:
+            memo.update(results)
+        return results
+
+    def set_local(self,key,value,ttl=None,generation=None):
+        """ stores a value in the local tier only """
+        if ttl is None:
+            ttl = self.ttl
+        if generation is None:
+            generation = self.generation(key_prefix(key))
+        self.cache[key] = LocalEntry(value,ttl,generation)
+        memo = getattr(self.request,'memo',None)
+        if memo is not None:
+            memo[key] = value
+      
+    def peek(self,key):
+        """ the value held locally for key, even if it has expired,
+            or None. does not count as a use of the entry """
+        generation = self.generation(key_prefix(key))
         try:
-            # randomly go to memcached directly once in a while
-            # this allows refreshing of the local instance cache from global
-            if random < 0.001: # TODO: find the optimal value
-                raise CacheKeyError
-            #logging.warning('local cache hit for %s' % key)
-            return self.cache[key]          
+            entry = self.cache.peek(key)
         except CacheKeyError:
-            result = from_binary(memcache.get(key))
-            if result:
-                self.set(key,result)
-            return result
-      
-    def set(self,key,value):
-        self.cache[key] = value
-        memcache.set(key,to_binary(value))
+            return None
+        if entry.generation == generation:
+            return entry.value
+        return None
+
+    def get_or_compute(self,key,compute,ttl=None):
+        """ returns the cached value for key, or computes and caches it.
+            concurrent missers share one computation (see compute_with_lease)
+        """
+        result = self.get(key)
+        if result is None:
+            result = compute_with_lease(key,compute,
+                                        lambda: self.get(key),
+                                        lambda value: self.set(key,value,ttl),
+                                        lambda: self.peek(key))
+        return result
+
+    def set(self,key,value,ttl=None,expiry=0):
+        """ ttl is how long the local tier trusts the value, expiry how
+            long memcache keeps it, in seconds (0 for as long as it can) """
+        generation = self.generation(key_prefix(key))
+        self.set_local(key,value,ttl,generation)
+        cache_set(self.memcache_key(key,generation),value,expiry)
+
+    def set_multi(self,mapping,ttl=None,expiry=0):
+        """ stores several values, with a single memcache call """
+        values = {}
+        for key,value in mapping.iteritems():
+            generation = self.generation(key_prefix(key))
+            self.set_local(key,value,ttl,generation)
+            values[self.memcache_key(key,generation)] = value
+        cache_set_multi(values,expiry)
   
     def invalidate_cache(self,key):
         try:
             del self.cache[key]
         except CacheKeyError:
             pass
-        memcache.delete(key)
+        memo = getattr(self.request,'memo',None)
+        if memo is not None:
+            memo.pop(key,None)
+        memcache.delete(self.memcache_key(key,self.generation(key_prefix(key))))
+
+    def stats(self):
+        """ memory accounting for the local tier, and the compression
+            achieved on values written to memcache """
+        return {'entries': len(self.cache),
+                'bytes': self.cache.bytes,
+                'evictions': self.cache.evictions,
+                'max_entries': self.cache.size,
+                'max_bytes': self.cache.max_bytes,
+                'stale_hits': self.stale_hits,
+                'refreshes': self.refreshes,
+                'generation_misses': self.generation_misses,
+                'compression_ratio': codec_stats()['compression_ratio'],
+                'recomputations_avoided': _lease_totals['recomputations_avoided'],
+                }
 
 # the module provides a cache at the instance level. 
 # use this mainly for stuff you know wont change, as cache invalidation will not filter to other instances
-instance_cache = TwoLevelCache()
+# the byte budget keeps the local tier well inside the memory of the smallest instance class
+INSTANCE_CACHE_BYTES = 32 * 1024 * 1024
+instance_cache = TwoLevelCache(max_bytes=INSTANCE_CACHE_BYTES)
+
+class CacheMiddleware(object):
+    """ WSGI middleware that scopes the bookkeeping of a TwoLevelCache
+        (instance_cache by default) to each request, and logs how often
+        the request memo was hit """
+    def __init__(self,app,cache=None):
+        self.app = app
+        self.cache = cache or instance_cache
+    def __call__(self,environ,start_response):
+        self.cache.begin_request()
+        try:
+            return self.app(environ,start_response)
+        finally:
+            stats = self.cache.end_request()
+            logging.debug('request cache memo: %(memo_hits)d hits, %(memo_misses)d misses, %(memo_entries)d entries' % stats)
 
 def cached_get_by_key_name(model,key_name,duration=None):
     key = '%s(%s)' % (model.kind(),key_name)
     result = instance_cache.get(key)
     if not result:
-        result = model.get_by_key_name(key_name)
-        instance_cache.set(key,result)
+        result = compute_with_lease(key,
+                                    lambda: model.get_by_key_name(key_name),
+                                    lambda: instance_cache.get(key),
+                                    lambda value: instance_cache.set(key,value,ttl=duration),
+                                    lambda: instance_cache.peek(key))
     return result
+
+def cached_get_by_key_name_multi(model,key_names,duration=None):
+    """ batch version of cached_get_by_key_name
+        returns entities in the same order as key_names (None if missing)
+        uses at most one memcache get, one datastore get and one memcache set
+    """
+    keys = ['%s(%s)' % (model.kind(),key_name) for key_name in key_names]
+    results = instance_cache.get_multi(keys)
+    missing = [(key,key_name) for key,key_name in zip(keys,key_names) if not results.get(key)]
+    if missing:
+        entities = model.get_by_key_name([key_name for key,key_name in missing])
+        fetched = dict(zip([key for key,key_name in missing],entities))
+        instance_cache.set_multi(fetched,ttl=duration)
+        results.update(fetched)
+    return [results[key] for key in keys]
     
     
     
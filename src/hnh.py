@@ -1,88 +1,339 @@
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
-from models import Player, Attribute, AttributeType, Action, action_types, base_ctx
-from caching import cached_get_by_key_name, instance_cache
+from models import Player, Attribute, AttributeType, AttributeDelta, Action, ActionType, PendingAction, compile_formula
+from actionscript import ScriptError
+from caching import cached_get_by_key_name, cached_get_by_key_name_multi, instance_cache, fetch_versions, bump_versions
 
-from datetime import datetime
-import parser
+from datetime import datetime, timedelta
+import logging
+import re
+import time
+import uuid
 from math import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Alert(Exception):
     pass
 
+# write-behind mode
+# instead of rewriting Attribute snapshots in the players' entity groups,
+# act records each effect as an AttributeDelta root entity. reads replay
+# pending deltas on top of the snapshot, and a task (fold_pending) folds
+# them into the snapshot once they are FOLD_DELAY seconds old, which also
+# gives non-ancestor queries time to see them.
+# the deltas are found with such a query (AttributeDelta.pending), so reads
+# are only eventually consistent until they are folded:
+# - a delta written a moment ago may be missing, so the value read can
+#   leave out recent effects, and a restriction can pass that would fail
+#   (folding still clamps the result to the attribute's bounds)
+# - get_current_info caches what it read under the player's new snapshot
+#   version, so a view may keep showing a value without such a delta until
+#   the fold task bumps the version again, about FOLD_DELAY seconds later
+# keeping the deltas in the players' entity groups would make reads exact,
+# but would bring back the contention this mode avoids.
+# drain pending fold tasks before switching this off again.
+WRITE_BEHIND = False
+FOLD_DELAY = 10
+
+# snapshot memoization
+# get_current_info caches each player's stored attributes and latest action
+# under a per-player version held in memcache, and fast forwards them to the
+# time of the view, which is pure arithmetic. every write to a player's
+# attributes bumps the version (see invalidate_snapshots), and act caches
+# the action it records under the target's new version, since the query
+# for a player's latest action is only eventually consistent. SNAPSHOT_TTL
+# bounds how long this instance trusts its local copy of a snapshot before
+# rereading it from memcache, and SNAPSHOT_EXPIRY how long memcache keeps
+# it, since every write leaves the previous version's copy behind.
+SNAPSHOT_TTL = 60
+SNAPSHOT_EXPIRY = 3600
+
 def timedelta_to_seconds(td):
     return td.seconds + 86400.0 * td.days + td.microseconds / 1000000.0   
+
+def elapsed_seconds(attribute,ref_time):
+    """ seconds from the attribute's latest snapshot to ref_time """
+    elapsed = timedelta_to_seconds(ref_time - attribute.latest_date)
+    if elapsed < 0:
+        if elapsed > -1:
+            elapsed = 0
+        else:
+            raise ValueError('attribute %s has a more recent timestamp (%s) than the reference time (%s)' % (attribute.name,attribute.latest_date,ref_time))
+    return elapsed
+
+def rate_towards_default(attribute_type,value,actor):
+    """ the rate per second at which value is currently changing:
+        positive while recovering, negative while decaying """
+    default = attribute_type.default_value
+    if value < default:
+        return attribute_type.recovery_rate(actor)
+    elif value > default:
+        return -attribute_type.decay_rate(actor)
+    return 0.0
+
+def predict_times(attribute_type,value,rate,ref_time):
+    """ when an attribute changing linearly at rate from value at ref_time
+        reaches its default, minimum and maximum values.
+        returns (default_at, min_at, max_at)
+        each is a datetime, or None if it will not get there on its own:
+        when the rate moves it away from its default (a formula can give
+        either sign), or so slowly that the time is not representable.
+    """
+    default = attribute_type.default_value
+    default_at = min_at = max_at = None
+    if value == default:
+        default_at = ref_time
+    elif rate != 0:
+        seconds = (default - value) / rate
+        if seconds >= 0:
+            try:
+                default_at = ref_time + timedelta(seconds=seconds)
+            except OverflowError:
+                pass
+    if default_at is not None:
+        if default >= attribute_type.max_value:
+            max_at = default_at
+        if default <= attribute_type.min_value:
+            min_at = default_at
+    return default_at, min_at, max_at
+
+class AttributeState(object):
+    """ what the views show of one attribute, including when it will reach
+        its default, minimum and maximum values so that clients can
+        animate it without asking again.
+        one of these is built per attribute per player on every view, so it
+        is a slotted record rather than a dict: the values it shares with
+        its AttributeType are references, not copies. item[name] works as
+        well as item.name, which lets django templates find fields on the
+        first lookup.
+    """
+    __slots__ = ('name','value','rate','reference_time','default_at','min_at','max_at',
+                 'color','min_value','max_value','default_value','order')
+
+    def __init__(self,attribute_type,name,value,rate,ref_time):
+        self.name = name
+        self.value = value
+        self.rate = rate
+        self.reference_time = ref_time
+        self.default_at,self.min_at,self.max_at = predict_times(attribute_type,value,rate,ref_time)
+        self.color = attribute_type.color
+        self.min_value = attribute_type.min_value
+        self.max_value = attribute_type.max_value
+        self.default_value = attribute_type.default_value
+        self.order = attribute_type.order
+
+    @property
+    def percentage(self):
+        return 100*self.value/self.max_value
+
+    # raises AttributeError rather than KeyError for unknown fields, which
+    # django's variable lookup handles the same way
+    __getitem__ = object.__getattribute__
+
+    def __repr__(self):
+        return '<AttributeState %s=%r at %s>' % (self.name,self.value,self.reference_time)
+
+def recover_linear(latest_values,elapsed,default,recovery,decay):
+    """ moves each value towards default at a constant rate per second:
+        recovery when below it, decay when above it. never overshoots.
+        uses a single numpy array pass when numpy is available.
+    """
+    if numpy is not None:
+        latest_values = numpy.array(latest_values,dtype=float)
+        elapsed = numpy.array(elapsed,dtype=float)
+        recovered = numpy.minimum(latest_values + elapsed * recovery, default)
+        decayed = numpy.maximum(latest_values - elapsed * decay, default)
+        return numpy.where(latest_values < default, recovered,
+                           numpy.where(latest_values > default, decayed, latest_values)).tolist()
+    return [min(v + e * recovery, default) if v < default else
+            max(v - e * decay, default) if v > default else v
+            for v,e in zip(latest_values,elapsed)]
+
+def fast_forward_values(attributes,actors,attribute_types,ref_time):
+    """ fast forwards many attributes, possibly of many players, to ref_time
+
+        attributes of the same AttributeType with constant recovery and decay
+        rates are computed together in one array operation; attributes whose
+        rates are formulas of the actor are fast forwarded one at a time.
+
+    Args:
+        attributes - list of Attribute
+        actors - the Thespian of each attribute's player
+        attribute_types - dict of AttributeType by name
+        ref_time - datetime to fast forward to
+    Returns:
+        list of the new values, in the same order as attributes
+    """
+    values = [None] * len(attributes)
+    groups = {}
+    for i,attribute in enumerate(attributes):
+        groups.setdefault(attribute.name,[]).append(i)
+    for name,indexes in groups.iteritems():
+        attribute_type = attribute_types[name]
+        recovery = compile_formula(attribute_type.recovery)
+        decay = compile_formula(attribute_type.decay)
+        if isinstance(recovery,float) and isinstance(decay,float):
+            new_values = recover_linear([attributes[i].latest_value for i in indexes],
+                                        [elapsed_seconds(attributes[i],ref_time) for i in indexes],
+                                        attribute_type.default_value,recovery,decay)
+            for i,value in zip(indexes,new_values):
+                values[i] = value
+        else:
+            for i in indexes:
+                values[i] = actors[i].forward_value(attributes[i],ref_time)
+    return values
     
 class Thespian(object):
     ''' Instantiate one of these to play out the effects of an action
         Thespian.add_effect() queues up the effects of that action
-        Thespian.run_effects_at() saves all queued effects to the datastore
+        Thespian.run_effects_at() saves all queued effects to the datastore,
+        for a Thespian acting alone: act and act_many commit the actor and
+        target together (see apply_stored)
     '''
-    def __init__(self,player):
+    default_attributes = ['health','energy']
+
+    def __init__(self,player,attributes=None,names=None):
+        """ attributes, if given, are all of the player's stored Attributes
+            otherwise they are queried from the datastore
+            names, if given, limits the Thespian to those attributes:
+            attributes holds whichever of them are stored
+        """
         self.player = player
         
         self.attribute_types = {}
-        cache_key = 'AttributeType.all()'
-        all_attr_types = instance_cache.get(cache_key)
-        if not all_attr_types:
-            all_attr_types = AttributeType.all().fetch(1000)
-            instance_cache.set(cache_key,all_attr_types)
-        for attribute_type in all_attr_types:
+        for attribute_type in AttributeType.cached_all():
             self.attribute_types[attribute_type.name] = attribute_type
             
-        self.update()
+        if attributes is None:
+            self.update()
+        else:
+            self.load(attributes,names)
+
+    @classmethod
+    def load_many(klass,players,names=None):
+        """ builds a Thespian for each player, fetching their attributes
+            with a single batch get. the attribute keys are derived from
+            each player's key and the attribute names, so no queries are
+            needed.
+            names, if given, holds the names of the attributes to load for
+            each player (see actionscript.CompiledScript.attribute_names).
+            otherwise all of the AttributeTypes are loaded, as they are for
+            a player when any of its named attributes has a recovery or
+            decay formula, which may read the others.
+        """
+        attribute_types = AttributeType.cached_all()
+        all_names = [attribute_type.name for attribute_type in attribute_types]
+        if names is None:
+            names = [all_names] * len(players)
+            partial = False
+        else:
+            formulas = set(attribute_type.name for attribute_type in attribute_types
+                           if not attribute_type.has_constant_rates())
+            names = [formulas.intersection(player_names) and all_names or player_names
+                     for player_names in names]
+            partial = True
+        keys = [Attribute.make_key(player,name)
+                for player,player_names in zip(players,names) for name in player_names]
+        entities = iter(db.get(keys))
+        thespians = []
+        for player,player_names in zip(players,names):
+            attributes = [e for e in [entities.next() for name in player_names] if e is not None]
+            thespian = klass(player,attributes,partial and player_names or None)
+            if WRITE_BEHIND:
+                deltas = AttributeDelta.pending(player)
+                if partial:
+                    deltas = [delta for delta in deltas if delta.name in player_names]
+                thespian.fold_deltas(deltas)
+            thespians.append(thespian)
+        return thespians
         
     def update(self):
+        # ancestor queries are strongly consistent
+        self.load(Attribute.all().ancestor(self.player).fetch(1000))
+        if WRITE_BEHIND:
+            self.fold_deltas(AttributeDelta.pending(self.player))
+
+    def fold_deltas(self,deltas):
+        """ replays AttributeDeltas on top of the attribute snapshots, in
+            time order, recovering and clamping between them exactly as if
+            each had been applied when it happened. deltas that are not
+            newer than their attribute's stored snapshot are already part
+            of it and are skipped.
+            returns the attributes that changed
+        """
+        snapshot_dates = dict((name,attr.latest_date) for name,attr in self.attributes.items()
+                              if attr.is_saved())
+        changed = {}
+        for delta in sorted(deltas,key=lambda d: d.date):
+            name = delta.name
+            if name in snapshot_dates and delta.date <= snapshot_dates[name]:
+                continue
+            if name not in self.attribute_types:
+                self.attribute_types[name] = cached_get_by_key_name(AttributeType,name)
+            attr_type = self.attribute_types[name]
+            attr = self.attributes.get(name)
+            if attr is None:
+                attr = self.attributes[name] = Attribute.prepare(self.player,name,attr_type)
+            if not attr.is_saved() and name not in changed:
+                # no snapshot yet: start from the default when the first delta happened
+                attr.latest_date = delta.date
+            new_value = self.forward_value(attr,delta.date) + delta.delta
+            attr.latest_value = min(max(new_value,attr_type.min_value),attr_type.max_value)
+            attr.latest_date = delta.date
+            changed[name] = attr
+        return changed.values()
+
+    def load(self,attrs,names=None):
         self.has_run = False
         self.attributes = {}
         self.effects = {}
         self.restricted = set()
-        attrs = Attribute.all().ancestor(self.player).fetch(1000)
         for attr in attrs:
             self.attributes[attr.name] = attr
-            if attr not in self.attribute_types:
-                self.attribute_types[attr.name] = cached_get_by_key_name(AttributeType,attr.name)
+        defaults = self.default_attributes
+        if names is not None:
+            defaults = [name for name in defaults if name in names]
+        # look up any attribute types not already known in one batch,
+        # so that add_effect never has to look one up on its own
+        unknown = set(self.attributes) | set(defaults) | set(names or [])
+        unknown = [name for name in unknown if name not in self.attribute_types]
+        if unknown:
+            for name,attribute_type in zip(unknown,cached_get_by_key_name_multi(AttributeType,unknown)):
+                self.attribute_types[name] = attribute_type
         # if you're missing default attributes, create them
-        for name in ['health','energy']: 
+        # attrs holds every stored attribute, so there is nothing to get
+        for name in defaults: 
             if name not in self.attributes:
-                self.attributes[name] = Attribute.get_or_prepare(self.player,name)
-                if name not in self.attribute_types:
-                    self.attribute_types[name] = cached_get_by_key_name(AttributeType,name)
+                self.attributes[name] = Attribute.prepare(self.player,name,self.attribute_types[name])
+
+    def forward_value(self,attribute,ref_time):
+        """ the attribute's value with any recovery or decay up to ref_time """
+        elapsed = elapsed_seconds(attribute,ref_time)
+        attribute_type = self.attribute_types[attribute.name]
+        default = attribute_type.default_value
+        latest_value = attribute.latest_value
+        if latest_value < default :
+            return min(latest_value + elapsed * attribute_type.recovery_rate(self), default)
+        elif latest_value > default :
+            return max(latest_value - elapsed * attribute_type.decay_rate(self), default)
+        return latest_value
 
     def fast_forward(self,attribute,ref_time=None):
         """ take an attribute value and fast forward any recovery to the ref_time
             ref_time defaults to now
+            returns an AttributeState
         """
-        attr_name = attribute.name
-        
         if ref_time is None:
                 ref_time = datetime.now()
-        elapsed = timedelta_to_seconds(ref_time - attribute.latest_date)
-        if elapsed < 0:
-            if elapsed > -1:
-                elapsed = 0
-            else:
-                raise ValueError('attribute %s has a more recent timestamp (%s) than the reference time (%s)' % (attr_name,attribute.latest_date,ref_time))
-
-        attribute_type = self.attribute_types[attr_name]
-        default = attribute_type.default_value
-        latest_value = attribute.latest_value
-        global_ctx = {'__builtins__':None}
-        local_ctx = {'actor':self}
-        local_ctx = dict(local_ctx.items() + base_ctx.items())
-        if latest_value < default :
-            new_value = min(latest_value + elapsed * eval(attribute_type.recovery,global_ctx,local_ctx), default)
-        elif latest_value > default :
-            new_value = max(latest_value - elapsed * eval(attribute_type.decay,global_ctx,local_ctx), default)
-        else:
-            new_value = latest_value
-                
-        return {'name': attr_name,
-                 'value': new_value,
-                 'color': attribute_type.color,
-                 'max_value': attribute_type.max_value,
-                 'percentage': 100*new_value/attribute_type.max_value,           
-                 'order': attribute_type.order,}
+        new_value = self.forward_value(attribute,ref_time)
+        attribute_type = self.attribute_types[attribute.name]
+        rate = rate_towards_default(attribute_type,new_value,self)
+        return AttributeState(attribute_type,attribute.name,new_value,rate,ref_time)
                 
                 
     def snapshot(self,ref_time=None):
@@ -101,35 +352,66 @@ class Thespian(object):
         self.restricted.add(attr)
         
     def add_effect(self,attr_name,amount):
+        """ raises Alert if there is no such attribute, e.g. when its
+            AttributeType was removed after the action's script was stored """
         try:
             self.effects[attr_name] += amount
         except KeyError:
+            if self.attribute_types.get(attr_name) is None:
+                self.attribute_types[attr_name] = cached_get_by_key_name(AttributeType,attr_name)
+                if self.attribute_types[attr_name] is None:
+                    raise Alert('attribute %s is not defined' % attr_name)
             self.effects[attr_name] = amount
-            self.attribute_types[attr_name] = cached_get_by_key_name(AttributeType,attr_name)
             
-    def run_effects_at(self,ref_time):
-        if self.has_run:
-            raise Alert('This Thespian has already completed running')
-        for name,delta in self.effects.items():
+    def effect_keys(self):
+        """ keys of the attributes the queued effects change """
+        return [Attribute.make_key(self.player,name) for name in self.effects]
+
+    def apply_effects_at(self,ref_time,stored):
+        """ applies the queued effects to the stored attributes
+            stored: the result of db.get(self.effect_keys())
+            returns the attributes to put
+        """
+        changed = []
+        for (name,delta),attr in zip(self.effects.items(),stored):
             attr_type = self.attribute_types[name]
             # create new attributes if you are acted upon by them
-            attr = Attribute.get_or_prepare(self.player,name,attr_type)
-            if not attr.is_saved():
+            if attr is None:
+                attr = Attribute.prepare(self.player,name,attr_type)
                 attr.latest_date = ref_time
-            current_value = self.fast_forward(attr,ref_time)['value']
+            current_value = self.forward_value(attr,ref_time)
             new_value = current_value + delta
-            if attr_type in self.restricted and (new_value < attr_type.min_value or new_value > attr_type.max_value):
+            if name in self.restricted and (new_value < attr_type.min_value or new_value > attr_type.max_value):
                 raise Alert('%s has insufficient %s' % (self.player.nickname,name))
             new_value = min(max(new_value,attr_type.min_value),attr_type.max_value)
             attr.latest_value = new_value
             attr.latest_date = ref_time
-            attr.put()
+            changed.append(attr)
+        return changed
+
+    def project_effects_at(self,ref_time):
+        """ dry run of the queued effects against the attributes already
+            loaded, without touching the datastore. raises Alert if a
+            restriction fails, otherwise returns the attributes as they
+            would be written. the loaded attributes themselves are updated.
+        """
+        return self.apply_effects_at(ref_time,[self.attributes.get(name) for name in self.effects])
+
+    def run_effects_at(self,ref_time):
+        """ commits the queued effects in a transaction of their own """
+        if self.has_run:
+            raise Alert('This Thespian has already completed running')
+        db.run_in_transaction(lambda: db.put(apply_stored([self],ref_time)))
+        invalidate_snapshots([self.player])
         self.has_run = True
     
-    def effect_summary(self):
+    def effect_summary(self,effects=None):
+        """ effects defaults to all of the queued effects """
+        if effects is None:
+            effects = self.effects
         output = []
-        for attr in sorted(self.effects.keys(),key=lambda x:self.attribute_types[x].order):
-            delta = self.effects[attr]
+        for attr in sorted(effects.keys(),key=lambda x:self.attribute_types[x].order):
+            delta = effects[attr]
             if delta > 0:
                 sign = '+'
             else:
@@ -138,33 +420,575 @@ class Thespian(object):
         return ' '.join(output)
 
 
-# TODO: concurrency
-# make this use a cross group (XG) transaction
-# also read the latest version of the player as part of the transaction so that noone else can modify
+# how many times act retries its transaction when it meets contention
+ACT_RETRIES = 5
+# the most entity groups (players) one cross group transaction may touch
+MAX_XG_GROUPS = 5
+
+def check_snapshot_writes():
+    """ raises RuntimeError in WRITE_BEHIND mode, where writing a snapshot
+        would drop the AttributeDeltas still pending against it: they are
+        only found by an eventually consistent query, and the snapshot's
+        new date makes fold_pending skip and delete them """
+    if WRITE_BEHIND:
+        raise RuntimeError('attribute snapshots cannot be written directly in write-behind mode')
+
+def apply_stored(thespians,now):
+    """ rereads the attributes the Thespians' effects change, with one
+        batch get, and applies the effects to them
+        call inside a transaction. returns the attributes to put
+    """
+    check_snapshot_writes()
+    keys = []
+    for thespian in thespians:
+        keys.extend(thespian.effect_keys())
+    stored = db.get(keys)
+    changed = []
+    offset = 0
+    for thespian in thespians:
+        count = len(thespian.effects)
+        changed.extend(thespian.apply_effects_at(now,stored[offset:offset+count]))
+        offset += count
+    return changed
+
 def act(actor,target,action,narration):
+    """ plays out an action and records it.
+        the effects on both players and the Action record are committed
+        together in one cross group (XG) transaction, which rereads the
+        attributes it changes so concurrent actions cannot be lost.
+        in WRITE_BEHIND mode the effects are recorded as deltas instead.
+    """
+    a,t,thespians = stage(actor,target,action)
+    now = datetime.now()
+    # reject invalid actions before anything is written
+    for thespian in thespians:
+        thespian.project_effects_at(now)
+    # the sharded counter runs its own transaction, so take the key first
+    date_key = Action.gen_date_key(now)
+
+    new_action = Action.prepare(actor,target,now,date_key,action,narration,
+                                a.effect_summary(),t.effect_summary())
+
+    def txn():
+        db.put(apply_stored(thespians,now) + [new_action])
+
+    if WRITE_BEHIND:
+        record_deltas(thespians,now,[new_action])
+    else:
+        options = db.create_transaction_options(xg=True,retries=ACT_RETRIES)
+        db.run_in_transaction_options(options,txn)
+        invalidate_snapshots([thespian.player for thespian in thespians],[new_action])
+    for thespian in thespians:
+        thespian.has_run = True
+    return new_action
+
+def effect_difference(after,before):
+    """ the effects queued between two copies of Thespian.effects """
+    return dict((name,delta - before.get(name,0)) for name,delta in after.items()
+                if name not in before or delta != before[name])
+
+def sum_effects(effects):
+    """ adds up several dicts of effects, like Thespian.effects """
+    total = {}
+    for effect in effects:
+        for name,delta in effect.items():
+            total[name] = total.get(name,0) + delta
+    return total
+
+def act_many(actor,targets,action,narration):
+    """ plays out an action by actor on each of targets, recording an
+        Action for each. the script runs once per target against Thespians
+        loaded with a single batch get, so effects on the actor add up, and
+        the whole batch is rejected if any restriction fails.
+        the effects are committed in XG transactions of the actor and at
+        most MAX_XG_GROUPS - 1 targets, each with the actor's effects for
+        just those targets. one sharded counter increment provides all the
+        date keys, and the Actions are then written with one batch put. if
+        a transaction fails, the targets already committed keep their
+        effects, and their Actions are written before the error is raised:
+        the actor has paid for exactly those.
+        in WRITE_BEHIND mode everything is recorded with one batch put.
+        returns the new Actions, one per distinct target, in order
+    """
+    action_type = ActionType.lookup(action)
+    if action_type is None:
+        raise Alert('unknown action %s' % action)
+    script = action_type.compiled()
+    unique_targets = []
+    target_keys = set()
+    for target in targets:
+        if target.key() not in target_keys:
+            target_keys.add(target.key())
+            unique_targets.append(target)
+    if not unique_targets:
+        return []
+    players = [actor] + [target for target in unique_targets if target.key() != actor.key()]
+    if actor.key() in target_keys:
+        names = [script.attribute_names('actor','target')]
+    else:
+        names = [script.attribute_names('actor')]
+    names += [script.attribute_names('target')] * (len(players) - 1)
+    thespians = Thespian.load_many(players,names)
+    by_key = dict((thespian.player.key(),thespian) for thespian in thespians)
+    a = thespians[0]
+
+    summaries = []
+    # the actor's effects for each target, including the target's own
+    # when the actor is acting on itself
+    shares = {}
+    for target in unique_targets:
+        t = by_key[target.key()]
+        actor_before,target_before = dict(a.effects),dict(t.effects)
+        try:
+            action_type.run_script(a,t)
+        except ScriptError, e:
+            raise Alert('%s failed: %s' % (action,e))
+        shares[target.key()] = effect_difference(a.effects,actor_before)
+        summaries.append((target,a.effect_summary(shares[target.key()]),
+                          t.effect_summary(effect_difference(t.effects,target_before))))
+    now = datetime.now()
+    # reject invalid actions before anything is written
+    for thespian in thespians:
+        thespian.project_effects_at(now)
+    date_keys = Action.gen_date_keys(now,len(summaries))
+    new_actions = [Action.prepare(actor,target,now,date_key,action,narration,actor_effects,target_effects)
+                   for (target,actor_effects,target_effects),date_key in zip(summaries,date_keys)]
+
+    if WRITE_BEHIND:
+        record_deltas(thespians,now,new_actions)
+    else:
+        options = db.create_transaction_options(xg=True,retries=ACT_RETRIES)
+        others = thespians[1:]
+        size = MAX_XG_GROUPS - 1
+        groups = [others[i:i+size] for i in range(0,len(others),size)] or [[]]
+        actor_effects = a.effects
+        committed = set()
+        try:
+            for i,group in enumerate(groups):
+                group_keys = [thespian.player.key() for thespian in group]
+                if i == 0 and actor.key() in target_keys:
+                    group_keys.append(actor.key())
+                a.effects = sum_effects([shares[key] for key in group_keys])
+                db.run_in_transaction_options(options,lambda: db.put(apply_stored([a] + group,now)))
+                committed.update(group_keys)
+        finally:
+            a.effects = actor_effects
+            recorded = [new_action for new_action in new_actions
+                        if Action.target.get_value_for_datastore(new_action) in committed]
+            if recorded:
+                db.put(recorded)
+            invalidate_snapshots([thespian.player for thespian in thespians
+                                  if thespian is a and recorded or thespian.player.key() in committed],
+                                 recorded)
+    for thespian in thespians:
+        thespian.has_run = True
+    return new_actions
+
+def stage(actor,target,action):
+    """ loads the Thespians for an action and runs its script on them
+        only the attributes the script can read or change are loaded, with
+        one batch get
+        returns (actor Thespian, target Thespian, distinct Thespians)
+    """
+    action_type = ActionType.lookup(action)
+    if action_type is None:
+        raise Alert('unknown action %s' % action)
+    script = action_type.compiled()
     acting_on_self = target.key().name() == actor.key().name()
-    a = Thespian(actor)
     if acting_on_self:
-        t = a
+        a = t = Thespian.load_many([actor],[script.attribute_names('actor','target')])[0]
+        thespians = [a]
     else:
-        t = Thespian(target)
-    action_types[action].run_script(a,t)
-    now = datetime.now()
-    db.run_in_transaction(a.run_effects_at,now)
-    if not acting_on_self:
-        db.run_in_transaction(t.run_effects_at,now)
-    Action.create(actor,target,now,action,narration,a.effect_summary(),t.effect_summary())
+        a,t = thespians = Thespian.load_many([actor,target],[script.attribute_names('actor'),
+                                                             script.attribute_names('target')])
+    try:
+        action_type.run_script(a,t)
+    except ScriptError, e:
+        raise Alert('%s failed: %s' % (action,e))
+    return a,t,thespians
+
+# queued mode
+# MainHandler validates an action and queues it with queue_action, then
+# returns straight away showing the projected result. a task (apply_queued)
+# applies each target's queued actions in order, so contention on a hot
+# target delays the task rather than the player's request.
+# the actions queued against a target within APPLY_DELAY seconds are
+# coalesced: their effects are summed and committed in one transaction on
+# the target's entity group, which limits how often it can be written.
+# the worker writes snapshots directly, so queued mode cannot be combined
+# with WRITE_BEHIND: queue_action refuses, and queued tasks fail (and are
+# retried) until WRITE_BEHIND is switched off and its deltas are folded.
+ASYNC_ACTIONS = False
+APPLY_DELAY = 1
+APPLY_BATCH = 20
+# tokens become the key names of PendingActions and queued Actions
+valid_token = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def queue_action(actor,target,action,narration,token=None):
+    """ validates an action and queues it to be applied by apply_queued
+        raises Alert if the action would be rejected now, and RuntimeError
+        in WRITE_BEHIND mode (see check_snapshot_writes)
+        token identifies the action: queueing the same token again, e.g.
+        when a form is submitted twice, does nothing more. one is made up
+        if not given.
+        returns preview(), with the token added
+    """
+    if not token:
+        token = uuid.uuid4().hex
+    elif not valid_token.match(token):
+        raise Alert('invalid token %r' % token)
+    check_snapshot_writes()
+    projection = preview(actor,target,action)
+    def txn():
+        if PendingAction.get_by_key_name(token) or Action.get(Action.queued_key(target,token)):
+            return
+        PendingAction(key_name=token,actor=actor,target=target,action=action,
+                      narration=narration,date=projection['reference_time']).put()
+        # enqueued only if the PendingAction is stored. transactional tasks
+        # cannot be named: the PendingAction is what makes a token unique
+        taskqueue.add(url='/tasks/apply',
+                      params={'token': token},
+                      countdown=APPLY_DELAY,
+                      transactional=True)
+    options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(options,txn)
+    projection['token'] = token
+    return projection
+
+def apply_queued(token):
+    """ applies the queued action token, along with the others queued
+        against its target, oldest first, coalescing them into as few
+        transactions as possible (see apply_coalesced). actions already
+        applied are skipped, so a task that runs twice does no harm.
+        returns the number of actions applied
+    """
+    check_snapshot_writes()
+    queued = PendingAction.get_by_key_name(token)
+    if queued is None:
+        return 0
+    target = PendingAction.target.get_value_for_datastore(queued)
+    # the query is only eventually consistent: it may miss this action,
+    # or ones queued just before it, which their own tasks will apply
+    batch = [pending for pending in PendingAction.pending(target,APPLY_BATCH)
+             if pending.key() != queued.key()]
+    batch.append(queued)
+    batch.sort(key=lambda pending: pending.date)
+    applied = 0
+    while batch:
+        run,batch = split_coalescible(batch,target)
+        applied += apply_coalesced(run,target)
+    return applied
+
+def split_coalescible(batch,target):
+    """ splits a target's queued actions after the longest run whose actors
+        and target fit in one XG transaction
+    """
+    actors = set()
+    for i,pending in enumerate(batch):
+        actor = PendingAction.actor.get_value_for_datastore(pending)
+        if actor != target and actor not in actors:
+            if len(actors) == MAX_XG_GROUPS - 1:
+                return batch[:i],batch[i:]
+            actors.add(actor)
+    return batch,[]
+
+def apply_coalesced(batch,target):
+    """ applies queued actions against one target in a single transaction:
+        their scripts run in order against Thespians loaded with one batch
+        get, and the summed effects on each player are written along with
+        an Action for each queued action.
+        restrictions are checked against the summed effects, and values are
+        clamped once, after all of them. if any action fails, the batch is
+        applied one action at a time instead (see apply_pending), which
+        drops just the actions that are no longer allowed.
+        the summed effects go through apply_stored like any other direct
+        write, so this refuses to run in WRITE_BEHIND mode too.
+        returns the number of actions applied
+    """
+    if len(batch) == 1:
+        return int(apply_pending(batch[0]))
+    tokens = [pending.key().name() for pending in batch]
+    done = [action is not None for action in db.get([Action.queued_key(target,token) for token in tokens])]
+    if any(done):
+        db.delete([pending for pending,applied in zip(batch,done) if applied])
+        batch = [pending for pending,applied in zip(batch,done) if not applied]
+        return apply_coalesced(batch,target) if batch else 0
+
+    player_keys = [target]
+    for pending in batch:
+        actor = PendingAction.actor.get_value_for_datastore(pending)
+        if actor not in player_keys:
+            player_keys.append(actor)
+    players = dict((player.key(),player) for player in db.get(player_keys))
+    thespians = Thespian.load_many([players[key] for key in player_keys])
+    by_key = dict(zip(player_keys,thespians))
+    t = by_key[target]
+    try:
+        summaries = []
+        for pending in batch:
+            action_type = ActionType.lookup(pending.action)
+            if action_type is None:
+                raise Alert('unknown action %s' % pending.action)
+            a = by_key[PendingAction.actor.get_value_for_datastore(pending)]
+            actor_before,target_before = dict(a.effects),dict(t.effects)
+            try:
+                action_type.run_script(a,t)
+            except ScriptError, e:
+                raise Alert('%s failed: %s' % (pending.action,e))
+            summaries.append((a.player,a.effect_summary(effect_difference(a.effects,actor_before)),
+                              t.effect_summary(effect_difference(t.effects,target_before))))
+        now = datetime.now()
+        for thespian in thespians:
+            thespian.project_effects_at(now)
+    except Alert, e:
+        logging.info('applying %d queued actions one at a time: %s' % (len(batch),e))
+        return sum(int(apply_pending(pending)) for pending in batch)
+
+    date_keys = Action.gen_date_keys(now,len(batch))
+    new_actions = [Action.prepare(actor,t.player,now,date_key,pending.action,pending.narration,
+                                  actor_effects,target_effects,token=pending.key().name())
+                   for pending,(actor,actor_effects,target_effects),date_key
+                   in zip(batch,summaries,date_keys)]
+    def txn():
+        if any(db.get([new_action.key() for new_action in new_actions])):
+            # another task got there first
+            return False
+        db.put(apply_stored(thespians,now) + new_actions)
+        return True
+    options = db.create_transaction_options(xg=True,retries=ACT_RETRIES)
+    try:
+        applied = db.run_in_transaction_options(options,txn)
+    except Alert, e:
+        logging.info('applying %d queued actions one at a time: %s' % (len(batch),e))
+        return sum(int(apply_pending(pending)) for pending in batch)
+    if not applied:
+        return apply_coalesced(batch,target)
+    db.delete(batch)
+    invalidate_snapshots([thespian.player for thespian in thespians],new_actions)
+    return len(batch)
+
+def apply_pending(pending):
+    """ applies one PendingAction, recording its Action under its token
+        and deleting it in the same transaction. an action that is no
+        longer allowed, e.g. because its actor has run out of energy since
+        it was queued, is dropped.
+        returns whether it was applied
+    """
+    token = pending.key().name()
+    try:
+        a,t,thespians = stage(pending.actor,pending.target,pending.action)
+        now = datetime.now()
+        for thespian in thespians:
+            thespian.project_effects_at(now)
+        date_key = Action.gen_date_key(now)
+        new_action = Action.prepare(pending.actor,pending.target,now,date_key,pending.action,
+                                    pending.narration,a.effect_summary(),t.effect_summary(),
+                                    token=token)
+        def txn():
+            if Action.get(new_action.key()) is not None:
+                db.delete(pending)
+                return False
+            db.put(apply_stored(thespians,now) + [new_action])
+            db.delete(pending)
+            return True
+        options = db.create_transaction_options(xg=True,retries=ACT_RETRIES)
+        applied = db.run_in_transaction_options(options,txn)
+    except Alert, e:
+        logging.warning('dropped queued action %s: %s' % (token,e))
+        pending.delete()
+        return False
+    if applied:
+        invalidate_snapshots([thespian.player for thespian in thespians],[new_action])
+    return applied
+
+def overlay_projection(status,projected):
+    """ a status from get_current_info with the attributes in projected
+        (AttributeStates, as returned by preview) in place of its own,
+        marked as provisional
+    """
+    by_name = dict((state.name,state) for state in projected)
+    status['attribute_state'] = [by_name.get(state.name,state) for state in status['attribute_state']]
+    status['provisional'] = True
+    return status
+
+def preview(actor,target,action,now=None):
+    """ what act would do, without writing anything
+        raises Alert if the action would be rejected
+        f(Player,Player,action) --> {effect summaries, projected attribute states}
+    """
+    if not now:
+        now = datetime.now()
+    a,t,thespians = stage(actor,target,action)
+    projected = {}
+    for thespian in thespians:
+        state = []
+        for attr in thespian.project_effects_at(now):
+            attribute_type = thespian.attribute_types[attr.name]
+            rate = rate_towards_default(attribute_type,attr.latest_value,thespian)
+            state.append(AttributeState(attribute_type,attr.name,attr.latest_value,rate,now))
+        projected[thespian.player.key()] = sorted(state,key=lambda x: x.order)
+    return {
+        'reference_time': now,
+        'action': action,
+        'actor_effects': a.effect_summary(),
+        'target_effects': t.effect_summary(),
+        'actor_state': projected[actor.key()],
+        'target_state': projected[target.key()],
+        }
+
+def record_deltas(thespians,now,new_actions):
+    """ write-behind half of act: writes one AttributeDelta per effect and
+        the Actions in a single batch put, with no transaction. act has
+        already checked the effects against the snapshot plus the pending
+        deltas its query found, which may miss recent ones (see
+        WRITE_BEHIND), so two close actions may both pass a restriction;
+        folding clamps the result to the attribute's bounds.
+    """
+    records = []
+    for thespian in thespians:
+        for name,delta in thespian.effects.items():
+            records.append(AttributeDelta(player=thespian.player,name=name,delta=float(delta),date=now))
+    db.put(records + new_actions)
+    invalidate_snapshots([thespian.player for thespian in thespians],new_actions)
+    for thespian in thespians:
+        schedule_fold(thespian.player)
+
+def schedule_fold(player):
+    """ makes sure a fold task will run for player within FOLD_DELAY seconds
+        tasks are named per player and time slot, so a burst of actions
+        against the same player only enqueues one
+    """
+    slot = int(time.time()) // max(FOLD_DELAY,1)
+    try:
+        taskqueue.add(url='/tasks/fold',
+                      params={'player': str(player.key())},
+                      name='fold-%s-%d' % (player.key(),slot),
+                      countdown=FOLD_DELAY)
+    except (taskqueue.TaskAlreadyExistsError,taskqueue.TombstonedTaskError):
+        pass
+
+def fold_pending(player):
+    """ folds a player's AttributeDeltas that are at least FOLD_DELAY seconds
+        old into their Attribute snapshots, then deletes them.
+        safe to run more than once: deltas no newer than a snapshot are
+        skipped when folding and reading.
+        returns the number of deltas folded
+    """
+    cutoff = datetime.now() - timedelta(seconds=FOLD_DELAY)
+    pending = AttributeDelta.pending(player)
+    settled = [d for d in pending if d.date <= cutoff]
+    if not settled:
+        if pending:
+            schedule_fold(player)
+        return 0
+    # built outside the transaction, which may only read the player's group
+    thespian = Thespian(player,[])
+    def txn():
+        thespian.load(Attribute.all().ancestor(player).fetch(1000))
+        db.put(thespian.fold_deltas(settled))
+    db.run_in_transaction(txn)
+    db.delete(settled)
+    invalidate_snapshots([player])
+    if len(settled) < len(pending):
+        schedule_fold(player)
+    return len(settled)
     
 def get_current_info(player,now=None):
     """ used in view   
         f(Player) --> (PlayerState,Action)
     """
+    return get_current_info_many([player],now)[0]
+
+def snapshot_version_name(player):
+    return str(player.key())
+
+def snapshot_key(player,version):
+    return 'AttributeSnapshot(%s#%d)' % (player.key(),version)
+
+def latest_action_key(player_key,version):
+    return 'LatestAction(%s#%d)' % (player_key,version)
+
+def invalidate_snapshots(players,new_actions=()):
+    """ call after writing players' attributes or actions against them:
+        the next get_current_info on any instance rereads their snapshots.
+        new_actions, if given, are cached as their targets' latest actions.
+    """
+    versions = bump_versions([snapshot_version_name(player) for player in players],'snapshot:')
+    latest = {}
+    for new_action in new_actions:
+        target = Action.target.get_value_for_datastore(new_action)
+        version = versions.get(str(target))
+        if version is not None:
+            latest[latest_action_key(target,version)] = [new_action]
+    if latest:
+        instance_cache.set_multi(latest,ttl=SNAPSHOT_TTL,expiry=SNAPSHOT_EXPIRY)
+
+def load_snapshots(players,now):
+    """ the Thespian and latest action of each player, from the snapshot
+        cache where their versions are unchanged. missing attributes are
+        loaded with a single batch get, and all of the misses are cached
+        with a single memcache set.
+        the cached Attributes are shared, so callers must not change them.
+        f([Player]) --> [(Thespian,Action)]
+    """
+    versions = fetch_versions([snapshot_version_name(player) for player in players],'snapshot:')
+    versions = [versions[snapshot_version_name(player)] for player in players]
+    snapshot_keys = [snapshot_key(player,version) for player,version in zip(players,versions)]
+    action_keys = [latest_action_key(player.key(),version) for player,version in zip(players,versions)]
+    cached = instance_cache.get_multi(snapshot_keys + action_keys)
+    fresh = {}
+    missing = [(key,player) for key,player in zip(snapshot_keys,players) if key not in cached]
+    if missing:
+        thespians = Thespian.load_many([player for key,player in missing])
+        for (key,player),thespian in zip(missing,thespians):
+            attributes = thespian.attributes.values()
+            for attribute in attributes:
+                if not attribute.is_saved():
+                    attribute.latest_date = now
+            fresh[key] = attributes
+    for key,player in zip(action_keys,players):
+        if key not in cached:
+            # a list, so that players nobody has acted on are cached too
+            fresh[key] = [action for action in [Action.latest_action(player)] if action]
+    if fresh:
+        instance_cache.set_multi(fresh,ttl=SNAPSHOT_TTL,expiry=SNAPSHOT_EXPIRY)
+        cached.update(fresh)
+    output = []
+    for player,skey,akey in zip(players,snapshot_keys,action_keys):
+        last_action = (list(cached[akey]) or [None])[0]
+        output.append((Thespian(player,list(cached[skey])),last_action))
+    return output
+
+def get_current_info_many(players,now=None):
+    """ get_current_info for many players at once, fast forwarding all of
+        their attributes together (see fast_forward_values)
+        f([Player]) --> [(PlayerState,Action)]
+    """
     if not now: 
         now = datetime.now()
-    return {
-        'reference_time': now,
-        'player': player,
-        'attribute_state': sorted(Thespian(player).snapshot(now).values(),key=lambda x: x['order']),
-        'last_action': Action.latest_action(player)    
-        }
+    loaded = load_snapshots(players,now)
+    attribute_types = {}
+    attributes = []
+    actors = []
+    for thespian,last_action in loaded:
+        attribute_types.update(thespian.attribute_types)
+        for attribute in thespian.attributes.values():
+            attributes.append(attribute)
+            actors.append(thespian)
+    values = iter(fast_forward_values(attributes,actors,attribute_types,now))
+    output = []
+    for player,(thespian,last_action) in zip(players,loaded):
+        state = []
+        for attribute in thespian.attributes.values():
+            attribute_type = thespian.attribute_types[attribute.name]
+            value = values.next()
+            rate = rate_towards_default(attribute_type,value,thespian)
+            state.append(AttributeState(attribute_type,attribute.name,value,rate,now))
+        output.append({
+            'reference_time': now,
+            'player': player,
+            'attribute_state': sorted(state,key=lambda x: x.order),
+            'last_action': last_action,
+            })
+    return output
     
@@ -32,16 +32,20 @@ discarded. [1]_
 """
 
 from __future__ import generators
+import threading
 import time
-from heapq import heappush, heappop, heapify
 
-__version__ = "0.2"
-__all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
+__version__ = "0.3"
+__all__ = ['CacheKeyError', 'LRUCache', 'ShardedLRUCache', 'DEFAULT_SIZE',
+           'DEFAULT_SHARDS']
 __docformat__ = 'reStructuredText en'
 
 DEFAULT_SIZE = 16
 """Default size of a new LRUCache object, if no 'size' argument is given."""
 
+DEFAULT_SHARDS = 16
+"""Default number of shards of a new ShardedLRUCache object."""
+
 class CacheKeyError(KeyError):
     """Error raised when cache requests fail
     
@@ -57,6 +61,22 @@ class LRUCache(object):
     emulate a Python mapping type. You can use an LRU cache more or less like
     a Python dictionary, with the exception that objects you put into the
     cache may be discarded before you take them out.
+
+    Records are kept in a dictionary for lookup and threaded on a circular
+    doubly-linked list in recency order, so reads, writes and evictions all
+    take constant time regardless of the number of cached records.
+
+    The cache can also be bounded by memory: pass 'max_bytes' together with
+    a 'sizeof' function that estimates the size of a value in bytes. Each
+    value is measured once, when it is stored, and least-recently-used
+    records are discarded until the new one fits. 'bytes' holds the current
+    estimated total and 'evictions' counts the records discarded to make
+    room (explicit deletions are not counted). A value larger than
+    'max_bytes' is not cached, unless 'max_item_bytes' allows it: it is
+    then kept alone, once every other record has been discarded.
+
+    LRUCache does no locking of its own; use ShardedLRUCache to share a
+    cache between threads.
     
     Some example usage::
 	
@@ -83,6 +103,9 @@ class LRUCache(object):
 	    
     if 0 not in cache: print 'Zero was discarded.'
 
+    sized = LRUCache(1000, max_bytes=2**20, sizeof=len) # at most 1MB of strings
+    print sized.bytes, sized.evictions
+
     if 42 in cache:
         del cache[42] # Manual deletion
 
@@ -92,104 +115,324 @@ class LRUCache(object):
     
     class __Node(object):
         """Record of a cached value. Not for public consumption."""
+        __slots__ = ('key', 'obj', 'atime', 'mtime', 'nbytes', 'prev', 'next')
         
-        def __init__(self, key, obj, timestamp):
+        def __init__(self, key, obj, timestamp, nbytes=0):
             object.__init__(self)
             self.key = key
             self.obj = obj
             self.atime = timestamp
             self.mtime = self.atime
-	    
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
+            self.nbytes = nbytes
+            self.prev = self.next = self
 
         def __repr__(self):
             return "<%s %s => %s (%s)>" % \
                    (self.__class__, self.key, self.obj, \
                     time.asctime(time.localtime(self.atime)))
 
-    def __init__(self, size=DEFAULT_SIZE):
+    def __init__(self, size=DEFAULT_SIZE, max_bytes=None, sizeof=None,
+                 max_item_bytes=None):
         # Check arguments
         if size <= 0:
             raise ValueError, size
         elif type(size) is not type(0):
             raise TypeError, size
+        if max_bytes is not None:
+            if max_bytes <= 0:
+                raise ValueError, max_bytes
+            elif sizeof is None:
+                raise TypeError, 'max_bytes requires a sizeof function'
+        if max_item_bytes is not None and max_item_bytes <= 0:
+            raise ValueError, max_item_bytes
         object.__init__(self)	
-        self.__heap = []
+        # sentinel of the recency list: root.next is the least recently
+        # used record, root.prev the most recently used one
+        self.__root = self.__Node(None, None, 0)
         self.__dict = {}
+        self.__sizeof = sizeof
+        self.bytes = 0
+        """Estimated size in bytes of all cached values (0 without sizeof)."""
+        self.evictions = 0
+        """Number of records discarded to respect 'size' or 'max_bytes'."""
         self.size = size
         """Maximum size of the cache.
         If more than 'size' elements are added to the cache,
         the least-recently-used ones will be discarded."""
+        self.max_bytes = max_bytes
+        """Maximum estimated size in bytes of the cached values, or None."""
+        self.max_item_bytes = max_item_bytes
+        """Largest single value cached, if larger than 'max_bytes'.
+        Values larger than both are not cached at all."""
+
+    def __unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __append(self, node):
+        # link node in as the most recently used record
+        root = self.__root
+        last = root.prev
+        node.prev = last
+        node.next = root
+        last.next = root.prev = node
+
+    def __remove(self, node):
+        self.__unlink(node)
+        del self.__dict[node.key]
+        self.bytes -= node.nbytes
+
+    def __discard_lru(self):
+        lru = self.__root.next
+        self.__remove(lru)
+        self.evictions += 1
+        return lru
+
+    def __over_budget(self, extra=0):
+        return self.max_bytes is not None and \
+               self.bytes + extra > self.max_bytes and \
+               len(self.__dict) > 0
 	
     def __len__(self):
-        return len(self.__heap)
+        return len(self.__dict)
     
     def __contains__(self, key):
-        return self.__dict.has_key(key)
+        return key in self.__dict
     
     def __setitem__(self, key, obj):
-        if self.__dict.has_key(key):
-            node = self.__dict[key]
+        if self.__sizeof is not None:
+            nbytes = self.__sizeof(obj)
+        else:
+            nbytes = 0
+        node = self.__dict.get(key)
+        if node is not None:
+            # the old value no longer counts against the budget
+            self.__remove(node)
+        if self.max_bytes is not None and nbytes > self.max_bytes and \
+           (self.max_item_bytes is None or nbytes > self.max_item_bytes):
+            # would flush the whole cache and still not fit
+            return
+        # size may have been reset, so we loop
+        while len(self.__dict) >= self.size or self.__over_budget(nbytes):
+            self.__discard_lru()
+        if node is not None:
             node.obj = obj
             node.atime = time.time()
             node.mtime = node.atime
-            heapify(self.__heap)
+            node.nbytes = nbytes
         else:
-            # size may have been reset, so we loop
-            while len(self.__heap) >= self.size:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
-            self.__dict[key] = node
-            heappush(self.__heap, node)
+            node = self.__Node(key, obj, time.time(), nbytes)
+        self.__dict[key] = node
+        self.bytes += nbytes
+        self.__append(node)
 	
     def __getitem__(self, key):
-        if not self.__dict.has_key(key):
+        node = self.__dict.get(key)
+        if node is None:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            node.atime = time.time()
-            heapify(self.__heap)
-            return node.obj
+        node.atime = time.time()
+        self.__unlink(node)
+        self.__append(node)
+        return node.obj
 	
     def __delitem__(self, key):
-        if not self.__dict.has_key(key):
+        node = self.__dict.get(key)
+        if node is None:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
-            return node.obj
+        self.__remove(node)
+        return node.obj
 
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
+        # iterate over a copy of the keys so that the cache can be
+        # modified (or read, which reorders it) while iterating
+        root = self.__root
+        keys = []
+        node = root.next
+        while node is not root:
+            keys.append(node.key)
+            node = node.next
+        for key in keys:
+            yield key
 
     def __setattr__(self, name, value):
         object.__setattr__(self, name, value)
-        # automagically shrink heap on resize
+        # automagically shrink cache on resize
         if name == 'size':
-            while len(self.__heap) > value:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+            while len(self.__dict) > value:
+                self.__discard_lru()
+        elif name == 'max_bytes':
+            while self.__over_budget():
+                self.__discard_lru()
 	    
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__dict))
 
     def mtime(self, key):
         """Return the last modification time for the cache record with key.
         May be useful for cache instances where the stored values can get
         'stale', such as caching file or network resource contents."""
-        if not self.__dict.has_key(key):
+        node = self.__dict.get(key)
+        if node is None:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            return node.mtime
+        return node.mtime
+
+    def peek(self, key):
+        """Return the value for key without counting it as a use: the
+        record keeps its place in the recency order and its access time."""
+        node = self.__dict.get(key)
+        if node is None:
+            raise CacheKeyError(key)
+        return node.obj
+
+class ShardedLRUCache(object):
+    """Thread-safe LRU cache made of independently locked LRUCache shards.
+
+    Keys are spread over 'shards' LRUCache objects by hash, each guarded by
+    its own lock, so threads working on different keys rarely wait for one
+    another. Recency is tracked per shard: a record is discarded when it is
+    the least-recently-used one of its shard, and iteration goes shard by
+    shard. 'size' and 'max_bytes' are totals, divided evenly between the
+    shards; 'bytes' and 'evictions' are summed over them. A single value
+    may be as large as 'max_bytes' in total: its shard discards all its
+    other records to hold it, so the total can then exceed 'max_bytes' by
+    at most that value's size.
+
+    A ShardedLRUCache with a single shard is an LRUCache behind one global
+    lock.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, max_bytes=None, sizeof=None,
+                 shards=DEFAULT_SHARDS):
+        if shards <= 0:
+            raise ValueError, shards
+        elif type(shards) is not type(0):
+            raise TypeError, shards
+        object.__init__(self)
+        self.__shards = [LRUCache(self.__share(size, shards),
+                                  self.__share(max_bytes, shards), sizeof,
+                                  max_item_bytes=max_bytes)
+                         for i in range(shards)]
+        self.__locks = [threading.Lock() for i in range(shards)]
+        self.__size = size
+        self.__max_bytes = max_bytes
+
+    def __share(self, total, shards):
+        if total is None:
+            return None
+        return max(1, -(-total // shards)) # ceiling division
+
+    def __shard(self, key):
+        i = hash(key) % len(self.__shards)
+        return self.__shards[i], self.__locks[i]
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.__shards])
+
+    def __contains__(self, key):
+        shard, lock = self.__shard(key)
+        lock.acquire()
+        try:
+            return key in shard
+        finally:
+            lock.release()
+
+    def __setitem__(self, key, obj):
+        shard, lock = self.__shard(key)
+        lock.acquire()
+        try:
+            shard[key] = obj
+        finally:
+            lock.release()
+
+    def __getitem__(self, key):
+        shard, lock = self.__shard(key)
+        lock.acquire()
+        try:
+            return shard[key]
+        finally:
+            lock.release()
+
+    def __delitem__(self, key):
+        shard, lock = self.__shard(key)
+        lock.acquire()
+        try:
+            del shard[key]
+        finally:
+            lock.release()
+
+    def __iter__(self):
+        for shard, lock in zip(self.__shards, self.__locks):
+            lock.acquire()
+            try:
+                keys = list(shard)
+            finally:
+                lock.release()
+            for key in keys:
+                yield key
+
+    def __repr__(self):
+        return "<%s (%d elements in %d shards)>" % \
+               (str(self.__class__), len(self), len(self.__shards))
+
+    def __resize(self, name, value):
+        for shard, lock in zip(self.__shards, self.__locks):
+            lock.acquire()
+            try:
+                setattr(shard, name, self.__share(value, len(self.__shards)))
+            finally:
+                lock.release()
+
+    def _get_size(self):
+        return self.__size
+    def _set_size(self, value):
+        self.__resize('size', value)
+        self.__size = value
+    size = property(_get_size, _set_size, doc=
+        """Maximum size of the cache, shared evenly between the shards.""")
+
+    def _get_max_bytes(self):
+        return self.__max_bytes
+    def _set_max_bytes(self, value):
+        self.__resize('max_bytes', value)
+        for shard, lock in zip(self.__shards, self.__locks):
+            lock.acquire()
+            try:
+                shard.max_item_bytes = value
+            finally:
+                lock.release()
+        self.__max_bytes = value
+    max_bytes = property(_get_max_bytes, _set_max_bytes, doc=
+        """Maximum estimated size in bytes, shared evenly between the shards.""")
+
+    @property
+    def bytes(self):
+        return sum([shard.bytes for shard in self.__shards])
+
+    @property
+    def evictions(self):
+        return sum([shard.evictions for shard in self.__shards])
+
+    @property
+    def shards(self):
+        return len(self.__shards)
+
+    def mtime(self, key):
+        """Return the last modification time for the cache record with key."""
+        shard, lock = self.__shard(key)
+        lock.acquire()
+        try:
+            return shard.mtime(key)
+        finally:
+            lock.release()
+
+    def peek(self, key):
+        """Return the value for key without counting it as a use."""
+        shard, lock = self.__shard(key)
+        lock.acquire()
+        try:
+            return shard.peek(key)
+        finally:
+            lock.release()
 
 if __name__ == "__main__":
     cache = LRUCache(25)
@@ -5,12 +5,19 @@ from google.appengine.ext import db
 
 # standard python imports
 from datetime import datetime
+import calendar
+import json
 import logging
 import random
+import uuid
 
 # hurt'n'heal specific imports
-from models import Player, Action, AttributeType
-from hnh import act, Alert, get_current_info
+from models import Player, Action, AttributeType, ActionType
+from actionscript import ScriptError
+from hnh import act, preview, Alert, get_current_info, get_current_info_many, fold_pending
+from hnh import queue_action, apply_queued, overlay_projection
+import hnh
+from caching import instance_cache, CacheMiddleware
 
 from facebook import *
 
@@ -38,13 +45,18 @@ class MainHandler(webapp2.RequestHandler):
         player = Player.get_or_create('facebook',graph['id'],graph['name'])
         
         action = self.request.get('action')
+        projection = None
         
         if action:
             try:
                 target = Player.get_or_create(self.request.get('target_network'),
                                               self.request.get('target_id'),
                                               self.request.get('target_username'))
-                act(player,target,action,self.request.get('narration'))
+                if hnh.ASYNC_ACTIONS:
+                    projection = queue_action(player,target,action,self.request.get('narration'),
+                                              self.request.get('token'))
+                else:
+                    act(player,target,action,self.request.get('narration'))
                 player = Player.get_by_key_name('facebook|%s' % graph['id']) # TODO: figure out why I have this step and comment on it
             except Alert, a:
                 logging.warning(a)           
@@ -60,7 +72,6 @@ class MainHandler(webapp2.RequestHandler):
                 included_players.add(target_key)
                 player_info.append({
                     'action': action, 
-                    'status': get_current_info(action.target,reftime),
                     'person': action.target,})
         left_over = 10 - len(player_info)
         friends_to_display = random.sample(get_facebook_friends(sr['oauth_token']),left_over)
@@ -72,13 +83,23 @@ class MainHandler(webapp2.RequestHandler):
             included_players.add(p.key().name())
             player_info.append({
                 'action': None,
-                'status': get_current_info(p,reftime),
                 'person': p,
                 })
             
-        status = get_current_info(player,reftime)
+        # fast forward everyone on the page together
+        statuses = get_current_info_many([info['person'] for info in player_info] + [player],reftime)
+        for info,info_status in zip(player_info,statuses):
+            info['status'] = info_status
+        status = statuses[-1]
+        if projection:
+            # show the queued action as if it had already been applied
+            for info in player_info:
+                if info['person'].key() == target.key():
+                    overlay_projection(info['status'],projection['target_state'])
+            overlay_projection(status,projection['actor_state'])
         self.response.out.write(template.render('index.html',{
             'signed_request': self.request.get('signed_request'),
+            'token'         : uuid.uuid4().hex,
             'user'          : graph,
             'player'        : player,
             'status'        : status,
@@ -96,12 +117,95 @@ class CurrentStatusHandler(webapp2.RequestHandler):
        
         target = Player.get_by_key_name(Player.make_key(network,id))
         refdate = self.request.get('refdate',None)
+        status = get_current_info(target,refdate)
+        if self.request.get('format') == 'json':
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.out.write(json.dumps(status_to_json(status)))
+            return
         self.response.out.write(template.render('status.html',{
-            'status' : get_current_info(target,refdate),
+            'status' : status,
             'person' : target,
             'action' : None,        
             }))
 
+class PreviewHandler(webapp2.RequestHandler):
+    """ dry run of an action for the UI: returns its projected effects as
+        json, or the reason it would be rejected, without writing anything
+    """
+    def get(self):
+        sig, payload = self.request.get('signed_request').split('.',1)
+        sr = decode_signed_req(payload)
+        self.response.headers['Content-Type'] = 'application/json'
+        if 'oauth_token' not in sr:
+            self.error(403)
+            self.response.out.write(json.dumps({'ok': False, 'error': 'not authorised'}))
+            return
+        graph = get_facebook_data('graph',sr['oauth_token'])
+        player = Player.get_by_key_name(Player.make_key('facebook',graph['id']))
+        target = Player.get_by_key_name(Player.make_key(self.request.get('target_network'),
+                                                        self.request.get('target_id')))
+        if not player or not target:
+            self.response.out.write(json.dumps({'ok': False, 'error': 'unknown player'}))
+            return
+        try:
+            projection = preview(player,target,self.request.get('action'))
+        except Alert, a:
+            self.response.out.write(json.dumps({'ok': False, 'error': str(a)}))
+            return
+        self.response.out.write(json.dumps({
+            'ok': True,
+            'reference_time': to_timestamp(projection['reference_time']),
+            'actor_effects': projection['actor_effects'],
+            'target_effects': projection['target_effects'],
+            'actor': [attribute_to_json(item) for item in projection['actor_state']],
+            'target': [attribute_to_json(item) for item in projection['target_state']],
+            }))
+
+def to_timestamp(date):
+    """ datetime (UTC) -> seconds since the epoch, for javascript clients """
+    if date is None:
+        return None
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1000000.0
+
+def status_to_json(status):
+    """ the parts of get_current_info a client needs to animate the bars:
+        each attribute's value and rate at reference_time, and when it will
+        reach its default, minimum and maximum values """
+    return {
+        'player': status['player'].key().name(),
+        'reference_time': to_timestamp(status['reference_time']),
+        'attributes': [attribute_to_json(item) for item in status['attribute_state']],
+        }
+
+def attribute_to_json(item):
+    return {
+        'name': item.name,
+        'value': item.value,
+        'rate': item.rate,
+        'min_value': item.min_value,
+        'max_value': item.max_value,
+        'default_value': item.default_value,
+        'default_at': to_timestamp(item.default_at),
+        'min_at': to_timestamp(item.min_at),
+        'max_at': to_timestamp(item.max_at),
+        }
+
+class FoldDeltasHandler(webapp2.RequestHandler):
+    """ task queue worker for write-behind mode (see hnh.WRITE_BEHIND)
+        folds a player's settled AttributeDeltas into their Attributes
+    """
+    def post(self):
+        player = Player.get(self.request.get('player'))
+        if player:
+            fold_pending(player)
+
+class ApplyQueuedHandler(webapp2.RequestHandler):
+    """ task queue worker for queued mode (see hnh.ASYNC_ACTIONS)
+        applies a queued action, and those queued before it on its target
+    """
+    def post(self):
+        apply_queued(self.request.get('token'))
+
 class UpdateHandler(webapp2.RequestHandler):
     """ utility handler to do updates required by schema changes
     """
@@ -111,6 +215,36 @@ class UpdateHandler(webapp2.RequestHandler):
             at.recovery="1.0"
             at.decay="2.0"
             at.put()
+        instance_cache.invalidate_prefix(AttributeType.kind())
+
+class ActionTypesHandler(webapp2.RequestHandler):
+    """ admin only: lists the action types as json, and adds or replaces
+        one without a deploy. the script is checked before it is stored.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps([{
+            'present_tense': action_type.present_tense,
+            'past_tense': action_type.past_tense,
+            'script': action_type.script,
+            'stored': action_type.is_saved(),
+            } for name,action_type in sorted(ActionType.cached_all().items())]))
+
+    def post(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        present_tense = self.request.get('present_tense').strip()
+        past_tense = self.request.get('past_tense').strip()
+        if not present_tense or not past_tense:
+            self.error(400)
+            self.response.out.write(json.dumps({'ok': False, 'error': 'present_tense and past_tense are required'}))
+            return
+        try:
+            ActionType.create(present_tense,past_tense,self.request.get('script'))
+        except ScriptError, e:
+            self.error(400)
+            self.response.out.write(json.dumps({'ok': False, 'error': str(e)}))
+            return
+        self.response.out.write(json.dumps({'ok': True}))
 
 class InitHandler(webapp2.RequestHandler):
     """ use this once to install the attribute types
@@ -129,8 +263,12 @@ class InitHandler(webapp2.RequestHandler):
                              decay="1.0",
                              description='most actions require energy to perform')
 
-app = webapp2.WSGIApplication([('/', MainHandler),
+app = CacheMiddleware(webapp2.WSGIApplication([('/', MainHandler),
                                ('/init', InitHandler),
                                ('/update', UpdateHandler),
                                ('/api/status/(.*)/(.*)', CurrentStatusHandler),
-                               ],debug=True)
+                               ('/api/preview', PreviewHandler),
+                               ('/tasks/fold', FoldDeltasHandler),
+                               ('/tasks/apply', ApplyQueuedHandler),
+                               ('/admin/actions', ActionTypesHandler),
+                               ],debug=True))
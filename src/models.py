@@ -2,7 +2,9 @@ from google.appengine.ext import db
 import logging
 
 from datetime import datetime
+import math
 from caching import instance_cache
+from actionscript import compile_script, ScriptError
 
 
 class Player(db.Model):
@@ -40,13 +42,32 @@ class AttributeType(db.Model):
     # f(Thespian) -> float
     recovery = db.StringProperty(default="1.0")
     decay = db.StringProperty(default="1.0")
+
+    def recovery_rate(self,actor):
+        return evaluate_formula(self.recovery,actor)
+
+    def decay_rate(self,actor):
+        return evaluate_formula(self.decay,actor)
+
+    def has_constant_rates(self):
+        """ whether recovery and decay are plain numbers, rather than
+            formulas that may read any of the Thespian's attributes """
+        return (isinstance(compile_formula(self.recovery),float) and
+                isinstance(compile_formula(self.decay),float))
     
+    @classmethod
+    def cached_all(klass):
+        """ all attribute types, from the instance cache """
+        return instance_cache.get_or_compute('%s.all()' % klass.kind(),
+                                             lambda: klass.all().fetch(1000))
+
     @classmethod
     def create(klass,name,**kw):
         new_entity = klass(key_name=name,
                            name=name,
                            **kw)
         new_entity.put()
+        instance_cache.invalidate_prefix(klass.kind())
         return new_entity
 
 
@@ -59,21 +80,34 @@ class Attribute(db.Model):
     attribute_type = db.ReferenceProperty(AttributeType)
     name = db.StringProperty() # denormalised from AttributeType
     latest_value = db.FloatProperty()
-    latest_date = db.DateTimeProperty(auto_now=True)
+    # the time latest_value was true at. set explicitly on every write:
+    # effects folded in later (see AttributeDelta) must keep their own time
+    latest_date = db.DateTimeProperty(auto_now_add=True)
+    @staticmethod
+    def make_key_name(player,name):
+        return '%s|%s' % (player.key().name(),name)
+    @classmethod
+    def make_key(klass,player,name):
+        """ the key of a player's attribute, whether it exists or not """
+        return db.Key.from_path(klass.kind(),klass.make_key_name(player,name),parent=player.key())
+    @classmethod
+    def prepare(klass,player,name,at=None):
+        """ a new, unsaved attribute at its default value """
+        if not at:
+            at = AttributeType.get_by_key_name(name)
+        if not at:
+            raise ValueError('attribute "%s" is not defined' % name)
+        return klass(key_name=klass.make_key_name(player,name),
+                     parent=player,
+                     attribute_type=at,
+                     name=name,
+                     latest_value=at.default_value)
     @classmethod
     def get_or_prepare(klass,player,name,at=None):
-        key_name = '%s|%s' % (player.key().name(),name)
+        key_name = klass.make_key_name(player,name)
         entity = klass.get_by_key_name(key_name,parent=player)
         if not entity:
-            if not at:
-                at = AttributeType.get_by_key_name(name)
-            if not at:
-                raise ValueError('attribute "%s" is not defined' % name)
-            entity = klass(key_name=key_name,
-                           parent=player,
-                           attribute_type=at,
-                           name=name,
-                           latest_value=at.default_value)
+            entity = klass.prepare(player,name,at)
         return entity
     @classmethod
     def get_or_create(klass,player,name):
@@ -91,57 +125,165 @@ class Attribute(db.Model):
         return entity
 
 
+class AttributeDelta(db.Model):
+    """ an effect on a player's attribute that has not yet been folded into
+        the Attribute snapshot (see hnh.WRITE_BEHIND)
+        a root entity, so recording one never contends with other writes
+    """
+    player = db.ReferenceProperty(Player,collection_name='pending_deltas')
+    name = db.StringProperty() # AttributeType.name
+    delta = db.FloatProperty()
+    date = db.DateTimeProperty()
+
+    @classmethod
+    def pending(klass,player):
+        """ a non-ancestor query, so only eventually consistent: deltas
+            written in the last moments may be missing """
+        return klass.all().filter('player =',player).fetch(1000)
+
+
 # create a safe context for eval and exec statements
 safe_functs = ['math','acos', 'asin', 'atan', 'atan2', 'ceil', 
                'cos', 'cosh', 'degrees', 'e', 'exp', 'fabs', 
                'floor', 'fmod', 'frexp', 'hypot', 'ldexp', 'log', 
                'log10', 'modf', 'pi', 'pow', 'radians', 'sin', 
                'sinh', 'sqrt', 'tan', 'tanh']
-base_ctx = dict([(k,locals().get(k,None)) for k in safe_functs])
+base_ctx = dict([(k,getattr(math,k,None)) for k in safe_functs])
+base_ctx['math'] = math
 base_ctx['abs'] = abs
 base_ctx['min'] = min
 base_ctx['max'] = max
 
-class ActionType(object):
-    def __init__(self,present_tense,past_tense,script):
-        self.present_tense = present_tense
-        self.past_tense = past_tense
-        self.compiled_script = compile(script,'<string>','exec')
+# recovery/decay formulas are compiled once per distinct source text and
+# shared by the whole process. an AttributeType whose formula changes simply
+# maps to a different entry. formulas that are plain numbers become floats.
+formula_globals = dict(base_ctx)
+formula_globals['__builtins__'] = None
+_compiled_formulas = {}
+
+def compile_formula(source):
+    try:
+        return _compiled_formulas[source]
+    except KeyError:
+        try:
+            formula = float(source)
+        except ValueError:
+            formula = compile(source,'<formula>','eval')
+        _compiled_formulas[source] = formula
+        return formula
+
+def evaluate_formula(source,actor):
+    """ f(formula source, Thespian) -> float """
+    formula = compile_formula(source)
+    if isinstance(formula,float):
+        return formula
+    return eval(formula,formula_globals,{'actor':actor})
+
+# action scripts are compiled once per distinct source text, like formulas,
+# so editing a stored ActionType's script simply maps to a new entry
+_compiled_scripts = {}
+
+def compile_action_script(source):
+    """ f(script source) -> actionscript.CompiledScript
+        raises actionscript.ScriptError if the script is not allowed
+    """
+    try:
+        return _compiled_scripts[source]
+    except KeyError:
+        script = compile_script(source,base_ctx)
+        _compiled_scripts[source] = script
+        return script
+
+class ActionType(db.Model):
+    """ something one player can do to another. key_name is present_tense
+        the built in action_types below can be overridden, and new ones
+        added, by storing ActionTypes: use the 'create' method
+    """
+    present_tense = db.StringProperty()
+    past_tense = db.StringProperty()
+    # see actionscript for what a script may do
+    # script(Thespian,Thespian) -> None
+    script = db.TextProperty()
+
+    def compiled(self):
+        return compile_action_script(self.script)
+
     def run_script(self,actor,target):
         ''' script(Thespian,Thespian) -> None
             outputs are all via side-effects of Thespian.add_effect()
         '''
-        cache_key = 'AttributeType.all()'
-        all_attr_types = instance_cache.get(cache_key)
-        if not all_attr_types:
-            all_attr_types = AttributeType.all().fetch(100)
-            instance_cache.set(cache_key,all_attr_types)
-        global_ctx = {'__builtins__':None}
-        local_ctx = {
-            'actor': actor,
-            'target': target,
-            'attribute_types' : all_attr_types,
-        }
-        local_ctx = dict(base_ctx.items() + local_ctx.items())
-        exec self.compiled_script in global_ctx, local_ctx
+        self.compiled().run(actor,target)
+
+    # (stored action types, merged dict) from the last call to cached_all
+    _merged = (None,None)
+
+    @classmethod
+    def cached_all(klass):
+        """ all action types by present tense: the built in ones, overridden
+            or extended by the stored ones, from the instance cache.
+            the merged dict is only rebuilt when the cache hands back a
+            different list of stored ones, so callers must not change it """
+        stored = instance_cache.get_or_compute('%s.all()' % klass.kind(),
+                                               lambda: klass.all().fetch(1000))
+        if not stored:
+            return action_types
+        merged_from,all_types = klass._merged
+        if merged_from is not stored:
+            all_types = dict(action_types)
+            for action_type in stored:
+                all_types[action_type.present_tense] = action_type
+            klass._merged = (stored,all_types)
+        return all_types
+
+    @classmethod
+    def lookup(klass,present_tense):
+        """ the ActionType called present_tense, or None """
+        return klass.cached_all().get(present_tense)
+
+    @classmethod
+    def create(klass,present_tense,past_tense,script):
+        """ stores a new or replacement action type
+            raises actionscript.ScriptError if the script is not allowed,
+            or names an attribute that has no AttributeType
+        """
+        names = compile_action_script(script).attribute_names('actor','target')
+        undefined = [name for name,attribute_type in zip(names,AttributeType.get_by_key_name(names))
+                     if attribute_type is None]
+        if undefined:
+            raise ScriptError('undefined attributes: %s' % ', '.join(undefined))
+        new_entity = klass(key_name=present_tense,
+                           present_tense=present_tense,
+                           past_tense=past_tense,
+                           script=db.Text(script))
+        new_entity.put()
+        instance_cache.invalidate_prefix(klass.kind())
+        return new_entity
+
+def builtin_action_type(present_tense,past_tense,script):
+    """ an unsaved ActionType, checked when the module is loaded """
+    compile_action_script(script)
+    return ActionType(key_name=present_tense,
+                      present_tense=present_tense,
+                      past_tense=past_tense,
+                      script=db.Text(script))
 
 action_types = {        
-    'heal' : ActionType('heal','healed',''' 
+    'heal' : builtin_action_type('heal','healed',''' 
 actor.restrict('energy')
 actor.add_effect('energy',-5)
 target.add_effect('health',7)'''),
-    'hurt' : ActionType('hurt','hurt', ''' 
+    'hurt' : builtin_action_type('hurt','hurt', ''' 
 actor.restrict('energy')
 actor.add_effect('energy',-10)
 target.add_effect('health',-10)'''),
-    'steal' : ActionType('steal','stole', ''' 
+    'steal' : builtin_action_type('steal','stole', ''' 
 actor.restrict('energy')
 actor.add_effect('energy',-16)
 actor.add_effect('health',+4)
 target.add_effect('health',-8)'''),
-    'last hurrah' : ActionType('last hurrah','last hurrahed', '''
-energy = actor.attributes['energy'].last_value
-health = actor.attributes['health'].last_value
+    'last hurrah' : builtin_action_type('last hurrah','last hurrahed', '''
+energy = actor.attributes['energy'].latest_value
+health = actor.attributes['health'].latest_value
 actor.add_effect('energy',-energy)
 target.add_effect('health',-(sqrt(100-health * energy)))'''),
     }
@@ -166,10 +308,10 @@ class Action(db.Model):
         """ return the past tense of the action 
             should probably be stored with the action type
         """
-        try:
-            return action_types[self.action].past_tense
-        except KeyError:
+        action_type = ActionType.lookup(self.action)
+        if action_type is None:
             return self.action
+        return action_type.past_tense
 
     def gen_age(self):
         """ generate a nice text string to describe how long ago the action happened
@@ -224,18 +366,68 @@ class Action(db.Model):
         count = increment('action_%s'%seconds)
         return '%s|%s' % (seconds,count)
 
+    @staticmethod
+    def gen_date_keys(date,number):
+        """ number date keys for the same date, from a single increment of
+            the sharded counter (see gen_date_key)
+        """
+        seconds = date.strftime('%012s')
+        last = increment('action_%s'%seconds,delta=number)
+        return ['%s|%s' % (seconds,count) for count in range(last-number+1,last+1)]
+
+    @classmethod
+    def prepare(cls,actor,target,date,date_key,action,narration,actor_effects,target_effects,token=None):
+        """ a new, unsaved action. date_key comes from gen_date_key
+            token, if given, is that of the queued action it records (see
+            queued_key)
+        """
+        key = None
+        if token:
+            key = cls.queued_key(target,token)
+        return cls(key=key,
+                   actor=actor,
+                   target=target,
+                   date = date,
+                   date_key=date_key,
+                   action=action,
+                   narration=narration,
+                   actor_effects=actor_effects,
+                   target_effects=target_effects)
+
+    @classmethod
+    def queued_key(cls,target,token):
+        """ the key of the Action recording a queued action (PendingAction)
+            it is stored in its target's entity group, so that it can be
+            written in the same transaction as the target's attributes
+        """
+        if not isinstance(target,db.Key):
+            target = target.key()
+        return db.Key.from_path(cls.kind(),token,parent=target)
+
     @classmethod
     def create(cls,actor,target,date,action,narration,actor_effects,target_effects):
         """ create a new action
         """
         logging.warning('narration: %s' % narration)
-        new_action = Action(actor=actor,
-                       target=target,
-                       date = date,
-                       date_key=Action.gen_date_key(date),
-                       action=action,
-                       narration=narration,
-                       actor_effects=actor_effects,
-                       target_effects=target_effects)
+        new_action = cls.prepare(actor,target,date,Action.gen_date_key(date),action,narration,
+                                 actor_effects,target_effects)
         new_action.put()
         return new_action
+
+
+class PendingAction(db.Model):
+    """ an action validated and queued by hnh.queue_action, waiting to be
+        applied. key_name is its idempotency token, which its Action is
+        stored under once it has been applied (see Action.queued_key).
+        a root entity, so queueing one never contends with other writes
+    """
+    actor = db.ReferenceProperty(Player,collection_name='queued_actions')
+    target = db.ReferenceProperty(Player,collection_name='queued_incidents')
+    action = db.StringProperty()
+    narration = db.StringProperty()
+    date = db.DateTimeProperty()
+
+    @classmethod
+    def pending(klass,target,limit=100):
+        """ the target's queued actions, oldest first """
+        return klass.all().filter('target =',target).order('date').fetch(limit)
@@ -32,12 +32,13 @@ def get_count(name):
     return total
 
 
-def increment(name,num_shards=None):
+def increment(name,num_shards=None,delta=1):
     """Increment the value for a given sharded counter.
 
     Parameters:
       name - The name of the counter
       num_shards - Specify the number of shards. If None, use the datastore default.
+      delta - How much to add to the counter.
     """
     if not num_shards:
         config = GeneralCounterShardConfig.get_or_insert(name, name=name)
@@ -50,11 +51,11 @@ def increment(name,num_shards=None):
         counter = GeneralCounterShard.get_by_key_name(shard_name)
         if counter is None:
             counter = GeneralCounterShard(key_name=shard_name, name=name)
-        counter.count += 1
+        counter.count += delta
         counter.put()
 
     db.run_in_transaction(txn)
-    value = memcache.incr(name, namespace='counter')
+    value = memcache.incr(name, delta=delta, namespace='counter')
     if value is None:
         value = get_count(name)
     return value
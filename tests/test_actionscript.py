@@ -0,0 +1,165 @@
+""" tests for the action script compiler and its whitelist (src/actionscript.py)
+
+    actionscript needs nothing from the app engine sdk, so these run
+    without it:
+
+        python -m unittest discover tests
+"""
+import math
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from actionscript import compile_script, ScriptError
+
+FUNCTIONS = {'sqrt': math.sqrt, 'pi': math.pi, 'min': min, 'max': max, 'math': math}
+
+
+class Value(object):
+    def __init__(self, latest_value):
+        self.latest_value = latest_value
+
+
+class FakeThespian(object):
+    """ records what a script does to it """
+    def __init__(self, **values):
+        self.attributes = dict((name, Value(value)) for name, value in values.items())
+        self.effects = {}
+        self.restricted = set()
+
+    def add_effect(self, name, amount):
+        self.effects[name] = self.effects.get(name, 0) + amount
+
+    def restrict(self, name):
+        self.restricted.add(name)
+
+
+def run(source, actor=None, target=None):
+    actor = actor or FakeThespian(energy=100.0, health=100.0)
+    target = target or FakeThespian(energy=100.0, health=100.0)
+    compile_script(source, FUNCTIONS).run(actor, target)
+    return actor, target
+
+
+class AllowedScriptTest(unittest.TestCase):
+
+    def test_effects_and_restrictions(self):
+        actor, target = run("actor.restrict('energy')\n"
+                            "actor.add_effect('energy', -5)\n"
+                            "target.add_effect('health', 7)")
+        self.assertEqual(actor.effects, {'energy': -5.0})
+        self.assertEqual(target.effects, {'health': 7.0})
+        self.assertEqual(actor.restricted, set(['energy']))
+
+    def test_reads_locals_and_functions(self):
+        actor, target = run("energy = actor.attributes['energy'].latest_value\n"
+                            "if energy > 50 and not energy > 90:\n"
+                            "    pass\n"
+                            "elif energy >= 90:\n"
+                            "    target.add_effect('health', -sqrt(energy) if energy else 0)\n"
+                            "else:\n"
+                            "    target.add_effect('health', 1)")
+        self.assertEqual(target.effects, {'health': -10.0})
+
+    def test_attribute_names(self):
+        script = compile_script("x = target.attributes['health'].latest_value\n"
+                                "if x > 0:\n"
+                                "    actor.add_effect('energy', -1)\n"
+                                "else:\n"
+                                "    actor.restrict('mana')", FUNCTIONS)
+        self.assertEqual(script.attribute_names('actor'), ['energy', 'mana'])
+        self.assertEqual(script.attribute_names('target'), ['health'])
+
+    def test_arithmetic_is_float(self):
+        actor, target = run("target.add_effect('health', 7 / 2)")
+        self.assertEqual(target.effects, {'health': 3.5})
+
+
+class RejectedScriptTest(unittest.TestCase):
+
+    def assertRejected(self, source):
+        self.assertRaises(ScriptError, compile_script, source, FUNCTIONS)
+
+    def test_statements(self):
+        for source in ["import os",
+                       "from os import path",
+                       "exec 'x = 1'",
+                       "while 1:\n    pass",
+                       "for i in actor.attributes:\n    pass",
+                       "def f():\n    pass",
+                       "class A(object):\n    pass",
+                       "print 1",
+                       "del actor",
+                       "x = 1\nx += 1",
+                       "a, b = 1, 2",
+                       "actor = 1",
+                       "sqrt = 1",
+                       "global x",
+                       "try:\n    pass\nexcept:\n    pass",
+                       "with actor:\n    pass",
+                       "1 +"]:
+            self.assertRejected(source)
+
+    def test_attribute_access(self):
+        for source in ["x = actor.__class__",
+                       "x = actor.player",
+                       "x = actor.attributes['energy'].__dict__",
+                       "x = actor.attributes[name].latest_value",
+                       "x = math.pi",
+                       "x = (1).__class__",
+                       "actor.add_effect(name, 1)",
+                       "actor.fold_deltas([])",
+                       "actor.add_effect('energy', amount=1)"]:
+            self.assertRejected(source)
+
+    def test_expressions(self):
+        for source in ["x = open('/etc/passwd')",
+                       "x = __import__('os')",
+                       "x = eval('1')",
+                       "x = globals()",
+                       "x = lambda: 1",
+                       "x = [1, 2]",
+                       "x = (1, 2)",
+                       "x = {}",
+                       "x = 'text'",
+                       "x = [i for i in (1,)]",
+                       "x = 1 << 100",
+                       "x = 1 | 2",
+                       "x = 1 in (1,)",
+                       "x = 1 is 1",
+                       "x = 1j",
+                       "x = `1`",
+                       "x = undefined",
+                       "x = math(1)",
+                       "x = sqrt(*[4])"]:
+            self.assertRejected(source)
+
+
+class RuntimeErrorTest(unittest.TestCase):
+
+    def test_arithmetic_errors(self):
+        for source in ["x = 1 / 0",
+                       "x = 10 ** 400",
+                       "x = (-8) ** 0.5",
+                       "x = sqrt(-1)",
+                       "x = y\ny = 1",
+                       "x = actor.attributes['mana'].latest_value"]:
+            self.assertRaises(ScriptError, run, source)
+
+    def test_effects_must_be_finite(self):
+        self.assertRaises(ScriptError, run, "target.add_effect('health', 1e308 * 10)")
+        self.assertRaises(ScriptError, run, "x = 1e308 * 10\ntarget.add_effect('health', x - x)")
+
+    def test_repeated_squaring_ends(self):
+        # with integer literals this built a number of millions of digits
+        source = "x = 9\n" + "x = x * x\n" * 40 + "target.add_effect('health', -x)"
+        start = time.time()
+        self.assertRaises(ScriptError, run, source)
+        self.assertTrue(time.time() - start < 1)
+
+
+if __name__ == '__main__':
+    unittest.main()